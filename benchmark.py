@@ -0,0 +1,42 @@
+import argparse
+import os
+
+from hparams import hparams
+from tacotron.benchmark import feeder_benchmark, griffin_lim_benchmark, precision_benchmark
+
+
+def main():
+	accepted_modes = ['feeder', 'griffin_lim', 'precision']
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--base_dir', default='')
+	parser.add_argument('--hparams', default='',
+		help='Hyperparameter overrides as a comma-separated list of name=value pairs')
+	parser.add_argument('--tacotron_input', default='training_data/train.txt')
+	parser.add_argument('--mode', default='feeder', help='what to benchmark: can be one of {}'.format(accepted_modes))
+	parser.add_argument('--batches', type=int, default=200, help='number of batches to time')
+	parser.add_argument('--warmup', type=int, default=20, help='number of batches to drain before timing')
+	parser.add_argument('--wav', default=None, help='audio file to invert with Griffin-Lim (griffin_lim and precision modes)')
+	parser.add_argument('--momentum', type=float, default=None, help='fast Griffin-Lim momentum to compare (griffin_lim mode, default: griffin_lim_momentum or 0.99)')
+	parser.add_argument('--tf_log_level', type=int, default=1, help='Tensorflow C++ log level.')
+	args = parser.parse_args()
+
+	if args.mode not in accepted_modes:
+		raise ValueError('accepted modes are: {}, found {}'.format(accepted_modes, args.mode))
+
+	modified_hp = hparams.parse(args.hparams)
+	os.environ['TF_CPP_MIN_LOG_LEVEL'] = str(args.tf_log_level)
+
+	if args.mode == 'feeder':
+		feeder_benchmark(args, modified_hp)
+	elif args.mode == 'griffin_lim':
+		if args.wav is None:
+			raise ValueError('griffin_lim mode needs an audio file to invert (--wav)')
+		griffin_lim_benchmark(args, modified_hp)
+	elif args.mode == 'precision':
+		if args.wav is None:
+			raise ValueError('precision mode needs an audio file to analyse and invert (--wav)')
+		precision_benchmark(args, modified_hp)
+
+
+if __name__ == '__main__':
+	main()
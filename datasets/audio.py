@@ -1,3 +1,7 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import librosa
 import librosa.filters
 import numpy as np
@@ -5,6 +9,12 @@ import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
 
+try:
+	#scipy >= 1.4, transforms float32 signals in single precision (numpy.fft only does as of numpy 2.0, and slower)
+	import scipy.fft as fft
+except ImportError:
+	from numpy import fft
+
 
 def load_wav(path, sr):
 	return librosa.core.load(path, sr=sr)[0]
@@ -47,7 +57,14 @@ def trim_silence(wav, hparams):
 	Useful for M-AILABS dataset if we choose to trim the extra 0.5 silence at beginning and end.
 	'''
 	#Thanks @begeekmyfriend and @lautjy for pointing out the params contradiction. These params are separate and tunable per dataset.
-	return librosa.effects.trim(wav, top_db= hparams.trim_top_db, frame_length=hparams.trim_fft_size, hop_length=hparams.trim_hop_size)[0]
+	#Same as librosa.effects.trim: frames (zero padded at the edges) whose mean square is within trim_top_db of the loudest one are kept
+	frames = _stft_engine(hparams, hparams.trim_fft_size, hparams.trim_hop_size, pad_mode='constant').frames(wav)
+	power = np.einsum('...i,...i->...', frames, frames) / hparams.trim_fft_size
+	db = 10 * np.log10(np.maximum(1e-10, power))
+	non_silent = np.flatnonzero(db > db.max() - hparams.trim_top_db)
+	if non_silent.size == 0:
+		return wav[:0]
+	return wav[non_silent[0] * hparams.trim_hop_size: (non_silent[-1] + 1) * hparams.trim_hop_size]
 
 def get_hop_size(hparams):
 	hop_size = hparams.hop_size
@@ -57,80 +74,299 @@ def get_hop_size(hparams):
 	return hop_size
 
 def linearspectrogram(wav, hparams):
-	D = _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
-	S = _amp_to_db(np.abs(D), hparams) - hparams.ref_level_db
-
-	if hparams.signal_normalization:
-		return _normalize(S, hparams)
-	return S
+	return SpectralAnalysis(wav, hparams).linear_spectrogram()
 
 def melspectrogram(wav, hparams):
-	D = _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
-	S = _amp_to_db(_linear_to_mel(np.abs(D), hparams), hparams) - hparams.ref_level_db
+	return SpectralAnalysis(wav, hparams).mel_spectrogram()
 
-	if hparams.signal_normalization:
-		return _normalize(S, hparams)
-	return S
+class SpectralAnalysis:
+	"""
+		Single pass analysis of a waveform.
 
-def inv_linear_spectrogram(linear_spectrogram, hparams):
-	'''Converts linear spectrogram to waveform using librosa'''
-	if hparams.signal_normalization:
-		D = _denormalize(linear_spectrogram, hparams)
-	else:
-		D = linear_spectrogram
+		Pre-emphasis and the STFT are run once, the magnitude is kept and both the linear and mel
+		spectrograms are derived from it on demand (same values as the historical per-spectrogram path).
+	"""
 
-	S = _db_to_amp(D + hparams.ref_level_db) #Convert back to linear
+	def __init__(self, wav, hparams):
+		self._hparams = hparams
+		self.magnitude = np.abs(_stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams))
 
-	if hparams.use_lws:
-		processor = _lws_processor(hparams)
-		D = processor.run_lws(S.astype(np.float64).T ** hparams.power)
-		y = processor.istft(D).astype(np.float32)
-		return inv_preemphasis(y, hparams.preemphasis, hparams.preemphasize)
-	else:
-		return inv_preemphasis(_griffin_lim(S ** hparams.power, hparams), hparams.preemphasis, hparams.preemphasize)
+	@property
+	def num_frames(self):
+		return self.magnitude.shape[1]
+
+	def linear_spectrogram(self):
+		return self._to_db(self.magnitude)
+
+	def mel_spectrogram(self):
+		return self._to_db(_linear_to_mel(self.magnitude, self._hparams))
+
+	def _to_db(self, S):
+		hparams = self._hparams
+		S = _amp_to_db(S, hparams) - hparams.ref_level_db
+
+		if hparams.signal_normalization:
+			return _normalize(S, hparams)
+		return S
 
+def inv_linear_spectrogram(linear_spectrogram, hparams):
+	'''Converts linear spectrogram to waveform using librosa'''
+	return _inv_magnitude(_linear_magnitude(linear_spectrogram, hparams), hparams)
 
 def inv_mel_spectrogram(mel_spectrogram, hparams):
 	'''Converts mel spectrogram to waveform using librosa'''
+	return _inv_magnitude(_mel_magnitude(mel_spectrogram, hparams), hparams)
+
+def inv_linear_spectrograms(linear_spectrograms, hparams):
+	'''Converts linear spectrograms (of any lengths) to waveforms, inverting them together (see griffin_lim_batch)'''
+	return _inv_magnitudes([_linear_magnitude(x, hparams) for x in linear_spectrograms], hparams)
+
+def inv_mel_spectrograms(mel_spectrograms, hparams):
+	'''Converts mel spectrograms (of any lengths) to waveforms, inverting them together (see griffin_lim_batch)'''
+	return _inv_magnitudes([_mel_magnitude(x, hparams) for x in mel_spectrograms], hparams)
+
+def _linear_magnitude(linear_spectrogram, hparams):
+	D = np.asarray(linear_spectrogram, dtype=_dsp_dtype(hparams))
 	if hparams.signal_normalization:
-		D = _denormalize(mel_spectrogram, hparams)
-	else:
-		D = mel_spectrogram
+		D = _denormalize(D, hparams)
+
+	return _db_to_amp(D + hparams.ref_level_db) #Convert back to linear
 
-	S = _mel_to_linear(_db_to_amp(D + hparams.ref_level_db), hparams)  # Convert back to linear
+def _mel_magnitude(mel_spectrogram, hparams):
+	D = np.asarray(mel_spectrogram, dtype=_dsp_dtype(hparams))
+	if hparams.signal_normalization:
+		D = _denormalize(D, hparams)
+
+	return _mel_to_linear(_db_to_amp(D + hparams.ref_level_db), hparams)  # Convert back to linear
 
+def _inv_magnitude(S, hparams):
 	if hparams.use_lws:
 		processor = _lws_processor(hparams)
 		D = processor.run_lws(S.astype(np.float64).T ** hparams.power)
 		y = processor.istft(D).astype(np.float32)
 		return inv_preemphasis(y, hparams.preemphasis, hparams.preemphasize)
 	else:
-		return inv_preemphasis(_griffin_lim(S ** hparams.power, hparams), hparams.preemphasis, hparams.preemphasize)
+		return inv_preemphasis(griffin_lim(S ** hparams.power, hparams), hparams.preemphasis, hparams.preemphasize)
+
+def _inv_magnitudes(magnitudes, hparams):
+	if hparams.use_lws:
+		#LWS inverts one spectrogram at a time
+		return [_inv_magnitude(S, hparams) for S in magnitudes]
+	wavs = griffin_lim_batch([S ** hparams.power for S in magnitudes], hparams)
+	return [inv_preemphasis(wav, hparams.preemphasis, hparams.preemphasize) for wav in wavs]
 
 def _lws_processor(hparams):
-	import lws
-	return lws.lws(hparams.n_fft, get_hop_size(hparams), fftsize=hparams.win_size, mode="speech")
+	def build():
+		import lws
+		return lws.lws(hparams.n_fft, get_hop_size(hparams), fftsize=hparams.win_size, mode="speech")
+	return dsp_cache.get('lws', (hparams.n_fft, get_hop_size(hparams), hparams.win_size), build)
 
-def _griffin_lim(S, hparams):
+#Largest fraction of padding frames in the groups of spectrograms inverted together by griffin_lim_batch
+_max_padding = 0.1
+
+def griffin_lim(S, hparams, convergence=None):
 	'''librosa implementation of Griffin-Lim
 	Based on https://github.com/librosa/librosa/issues/434
+
+	With hparams.griffin_lim_momentum > 0, runs fast Griffin-Lim (Perraudin et al., 2013): every phase estimate is
+	extrapolated from the previous one, which reaches the same spectral convergence in far fewer iterations. With
+	hparams.griffin_lim_tolerance, iterations stop once the spectral convergence improves by less than that fraction.
+	The spectral convergence of the estimate after 0, 1, ... iterations is appended to the convergence list if given.
+	'''
+	return _griffin_lim(S, hparams, convergence)
+
+def griffin_lim_batch(spectrograms, hparams, convergence=None):
+	'''Griffin-Lim on a list of magnitude spectrograms ([num_freq, frames], of any lengths), returns their waveforms
+
+	Spectrograms are sorted by length and inverted in groups of up to hparams.griffin_lim_batch_size close lengths (at
+	most _max_padding of padding frames): every group is zero padded into one [B, num_freq, frames] array and each
+	iteration runs a single batched STFT and ISTFT over all of them.
+	Waveforms are trimmed to their own length (hop_size * (frames - 1) samples, as single inversions). The padding
+	frames have a zero target magnitude, only the last samples of the shorter waveforms of a group are affected.
+	Spectral convergences are appended to the convergence list (one array of the group values per iteration).
 	'''
-	angles = np.exp(2j * np.pi * np.random.rand(*S.shape))
-	S_complex = np.abs(S).astype(np.complex)
-	y = _istft(S_complex * angles, hparams)
+	hop_size = get_hop_size(hparams)
+	wavs = [None] * len(spectrograms)
+	for group in _griffin_lim_groups([S.shape[1] for S in spectrograms], hparams.griffin_lim_batch_size):
+		lengths = [spectrograms[i].shape[1] for i in group]
+		#Frames are the rows in memory, as in the STFT outputs
+		S = np.zeros((len(group), max(lengths), spectrograms[group[0]].shape[0]), dtype=_dsp_dtype(hparams))
+		for i, index in enumerate(group):
+			S[i, :lengths[i]] = spectrograms[index].T
+
+		y = _griffin_lim(np.swapaxes(S, 1, 2), hparams, convergence)
+		for i, index in enumerate(group):
+			wavs[index] = y[i, :hop_size * (lengths[i] - 1)]
+	return wavs
+
+def _griffin_lim_groups(lengths, batch_size):
+	'''Indices of lengths sorted and split in groups of at most batch_size, padded by at most _max_padding of their frames'''
+	groups = []
+	for index in np.argsort(lengths, kind='mergesort'):
+		#Sorted, the new length is the maximal one of the group
+		if groups and len(groups[-1]) < batch_size and (len(groups[-1]) + 1) * lengths[index] <= (
+				1. + _max_padding) * (sum(lengths[i] for i in groups[-1]) + lengths[index]):
+			groups[-1].append(index)
+		else:
+			groups.append([index])
+	return groups
+
+def _griffin_lim(S, hparams, convergence):
+	engine = _stft_engine(hparams)
+	momentum = hparams.griffin_lim_momentum
+	tolerance = hparams.griffin_lim_tolerance
+	errors = []
+	S = np.abs(S).astype(engine.dtype, copy=False)
+	#Random phases laid out as the STFT outputs (frames are the rows in memory)
+	angles = np.exp(2j * np.pi * np.random.rand(*np.swapaxes(S, -1, -2).shape)).astype(engine.complex_dtype)
+	angles = np.swapaxes(angles, -1, -2)
+	angles *= S
+	y = engine.istft(angles)
+	rebuilt = 0.
 	for i in range(hparams.griffin_lim_iters):
-		angles = np.exp(1j * np.angle(_stft(y, hparams)))
-		y = _istft(S_complex * angles, hparams)
+		previous, rebuilt = rebuilt, engine.stft(y)
+		if tolerance is not None or convergence is not None:
+			errors.append(spectral_convergence(S, rebuilt))
+			#Batches stop once every spectrogram stalls
+			if tolerance is not None and len(errors) > 1 and np.all(errors[-2] - errors[-1] < tolerance * errors[-2]):
+				break
+		#Without momentum, this is the phase of the rebuilt spectrogram (original Griffin-Lim)
+		angles = _phase(rebuilt - (momentum / (1 + momentum)) * previous if momentum else rebuilt)
+		angles *= S
+		y = engine.istft(angles)
+	else:
+		if convergence is not None:
+			errors.append(spectral_convergence(S, engine.stft(y)))
+
+	if convergence is not None:
+		convergence.extend(errors)
 	return y
 
+def _phase(D):
+	#Same as np.exp(1j * np.angle(D)) without going through angles (0 where D is 0), overwrites D
+	magnitude = np.abs(D)
+	D /= np.maximum(magnitude, np.finfo(np.float32).tiny, out=magnitude)
+	return D
+
+def spectral_convergence(S, D):
+	'''Relative distance between target magnitude spectrograms and the magnitudes of complex ones (one value per [F, T] spectrogram)'''
+	return np.linalg.norm(np.abs(S) - np.abs(D), axis=(-2, -1)) / np.linalg.norm(S, axis=(-2, -1))
+
 def _stft(y, hparams):
 	if hparams.use_lws:
 		return _lws_processor(hparams).stft(y).T
 	else:
-		return librosa.stft(y=y, n_fft=hparams.n_fft, hop_length=get_hop_size(hparams), win_length=hparams.win_size)
+		return _stft_engine(hparams).stft(y)
 
 def _istft(y, hparams):
-	return librosa.istft(y, hop_length=get_hop_size(hparams), win_length=hparams.win_size)
+	return _stft_engine(hparams).istft(y)
+
+def _stft_engine(hparams, n_fft=None, hop_size=None, win_size=None, pad_mode=None):
+	'''STFT engine of the hparams analysis (or of the given n_fft, hop_size, win_size and pad_mode), shared by all callers'''
+	if n_fft is None:
+		n_fft, hop_size, win_size = hparams.n_fft, get_hop_size(hparams), hparams.win_size
+	pad_mode = pad_mode or hparams.stft_pad_mode
+	return dsp_cache.get('stft', (n_fft, hop_size, win_size, pad_mode, hparams.stft_workers, _dsp_dtype(hparams)),
+		lambda: STFT(n_fft, hop_size, win_size, pad_mode=pad_mode, workers=hparams.stft_workers, dtype=_dsp_dtype(hparams)))
+
+def _dsp_dtype(hparams):
+	#Spectrograms, magnitudes and signals are computed in this precision, complex spectrograms in the matching one
+	return np.dtype(hparams.dsp_dtype)
+
+#Number of signal lengths an STFT keeps the window sum of
+_max_window_sums = 64
+
+
+class STFT:
+	"""
+		Short-time Fourier transform for one (n_fft, hop_size, win_size) setting.
+
+		Frames, window and inverse are those of librosa.stft and librosa.istft: frames are centered (the signal is
+		padded by n_fft // 2 on both sides, with np.pad mode pad_mode) and windowed by a periodic Hann window of win_size samples zero
+		padded to n_fft, the inverse overlap-adds the windowed frames and divides by the summed squared window.
+		The window is computed once and the window sums of the last lengths inverted are kept. Real FFTs run over
+		blocks of frames on up to workers threads. float32 signals give complex64 spectrograms, float64 ones complex128.
+
+		Spectrograms are [..., 1 + n_fft // 2, frames] (librosa layout), leading dimensions are a batch of signals.
+	"""
+
+	def __init__(self, n_fft, hop_size, win_size=None, pad_mode='reflect', workers=1, dtype=np.float64):
+		self.n_fft = n_fft
+		self.hop_size = hop_size
+		self.pad_mode = pad_mode
+		self.workers = workers
+		self.dtype = np.dtype(dtype)
+		self.complex_dtype = np.result_type(self.dtype, np.complex64)
+
+		window = signal.get_window('hann', win_size or n_fft, fftbins=True)
+		self.window = librosa.util.pad_center(window, size=n_fft).astype(self.dtype)
+		self._window_sums = {}
+		self._pool = None
+		self._pool_pid = None
+
+	def frames(self, y):
+		'''[..., frames, n_fft] read only view of the centered frames of [..., samples] signals'''
+		y = np.asarray(y, dtype=self.dtype)
+		pad = self.n_fft // 2
+		y = np.pad(y, [(0, 0)] * (y.ndim - 1) + [(pad, pad)], mode=self.pad_mode)
+		num_frames = 1 + (y.shape[-1] - self.n_fft) // self.hop_size
+		return np.lib.stride_tricks.as_strided(y, shape=y.shape[:-1] + (num_frames, self.n_fft),
+			strides=y.strides[:-1] + (y.strides[-1] * self.hop_size, y.strides[-1]), writeable=False)
+
+	def stft(self, y):
+		D = self._transform(lambda x: fft.rfft(x * self.window, axis=-1), self.frames(y), 1 + self.n_fft // 2, self.complex_dtype)
+		return np.swapaxes(D, -1, -2)
+
+	def istft(self, D):
+		#Back to [..., frames, 1 + n_fft // 2], contiguous again for spectrograms computed from stft outputs
+		frames = self._transform(self._windowed_irfft, np.swapaxes(D, -1, -2), self.n_fft, self.dtype)
+
+		num_frames = frames.shape[-2]
+		y = np.zeros(frames.shape[:-2] + (self.n_fft + self.hop_size * (num_frames - 1),), dtype=self.dtype)
+		for t in range(num_frames):
+			y[..., t * self.hop_size: t * self.hop_size + self.n_fft] += frames[..., t, :]
+		y *= self._inverse_window_sum(num_frames)
+		return y[..., self.n_fft // 2: y.shape[-1] - self.n_fft // 2]
+
+	def _inverse_window_sum(self, num_frames):
+		scale = self._window_sums.get(num_frames)
+		if scale is None:
+			if len(self._window_sums) >= _max_window_sums:
+				self._window_sums.clear()
+			window_sum = np.zeros(self.n_fft + self.hop_size * (num_frames - 1))
+			square = self.window.astype(np.float64) ** 2
+			for t in range(num_frames):
+				window_sum[t * self.hop_size: t * self.hop_size + self.n_fft] += square
+			#Samples without any window overlap are left as they are
+			overlap = window_sum > np.finfo(self.dtype).tiny
+			scale = (1. / np.where(overlap, window_sum, 1.)).astype(self.dtype)
+			self._window_sums[num_frames] = scale
+		return scale
+
+	def _windowed_irfft(self, x):
+		frames = fft.irfft(x, n=self.n_fft, axis=-1)
+		frames *= self.window
+		return frames
+
+	def _transform(self, fft, x, size, dtype):
+		#Frames are split in one block per worker (FFTs release the GIL)
+		num_frames = x.shape[-2]
+		if self.workers <= 1 or num_frames < 2 * self.workers:
+			return fft(x).astype(dtype, copy=False)
+
+		out = np.empty(x.shape[:-1] + (size,), dtype=dtype)
+		block = -(-num_frames // self.workers)
+		def run(start):
+			out[..., start: start + block, :] = fft(x[..., start: start + block, :])
+		list(self._executor().map(run, range(0, num_frames, block)))
+		return out
+
+	def _executor(self):
+		#Threads do not survive a fork, forked preprocessing workers start their own
+		if self._pool_pid != os.getpid():
+			self._pool = ThreadPoolExecutor(self.workers)
+			self._pool_pid = os.getpid()
+		return self._pool
 
 ##########################################################
 #Those are only correct when using lws!!! (This was messing with Wavenet quality for a long time!)
@@ -162,20 +398,74 @@ def librosa_pad_lr(x, fsize, fshift):
 
 
 # Conversions
-_mel_basis = None
-_inv_mel_basis = None
+class DSPCache:
+	"""
+		Mel filterbanks, their pseudo-inverses, LWS processors and STFT engines, built once per audio setting.
+
+		Entries are keyed by the hparams fields they are built from, so a process working with several sample rates
+		or mel settings gets the right one for each. Lookups and builds are serialized by a reentrant lock (every entry
+		is built once even with concurrent callers, builds may look up other entries). hits and misses count the lookups
+		of every kind of entry.
+	"""
+
+	def __init__(self):
+		self.hits = {}
+		self.misses = {}
+		self._entries = {}
+		self._lock = threading.RLock()
+
+	def get(self, kind, key, build):
+		'''Entry of the given kind and key, built by build() on the first lookup'''
+		with self._lock:
+			entry = self._entries.get((kind, key))
+			if entry is None:
+				self.misses[kind] = self.misses.get(kind, 0) + 1
+				entry = self._entries[(kind, key)] = build()
+			else:
+				self.hits[kind] = self.hits.get(kind, 0) + 1
+			return entry
+
+	def set(self, kind, key, entry):
+		with self._lock:
+			self._entries[(kind, key)] = entry
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.hits.clear()
+			self.misses.clear()
+
+dsp_cache = DSPCache()
+
+def _mel_key(hparams, dtype):
+	#Cache key of the mel filterbank (and its pseudo-inverse) of an hparams mel setting in the given precision
+	return (hparams.sample_rate, hparams.n_fft, hparams.num_mels, hparams.fmin, hparams.fmax, np.dtype(dtype))
+
+def init_mel_basis(hparams, mel_basis=None):
+	'''Sets the mel filterbank of the hparams mel setting (built from hparams if not given), returns it'''
+	if mel_basis is None:
+		return _get_mel_basis(hparams)
+	dsp_cache.set('mel_basis', _mel_key(hparams, mel_basis.dtype), mel_basis)
+	return mel_basis
+
+def _get_mel_basis(hparams, dtype=np.float64):
+	dtype = np.dtype(dtype)
+	if dtype != np.float64:
+		return dsp_cache.get('mel_basis', _mel_key(hparams, dtype), lambda: _get_mel_basis(hparams).astype(dtype))
+	return dsp_cache.get('mel_basis', _mel_key(hparams, dtype), lambda: _build_mel_basis(hparams))
+
+def _get_inv_mel_basis(hparams, dtype=np.float64):
+	#The pseudo inverse is computed in float64 and used in the precision of the mel spectrograms
+	dtype = np.dtype(dtype)
+	if dtype != np.float64:
+		return dsp_cache.get('inv_mel_basis', _mel_key(hparams, dtype), lambda: _get_inv_mel_basis(hparams).astype(dtype))
+	return dsp_cache.get('inv_mel_basis', _mel_key(hparams, dtype), lambda: np.linalg.pinv(_get_mel_basis(hparams)))
 
 def _linear_to_mel(spectogram, hparams):
-	global _mel_basis
-	if _mel_basis is None:
-		_mel_basis = _build_mel_basis(hparams)
-	return np.dot(_mel_basis, spectogram)
+	return np.dot(_get_mel_basis(hparams, spectogram.dtype), spectogram)
 
 def _mel_to_linear(mel_spectrogram, hparams):
-	global _inv_mel_basis
-	if _inv_mel_basis is None:
-		_inv_mel_basis = np.linalg.pinv(_build_mel_basis(hparams))
-	return np.maximum(1e-10, np.dot(_inv_mel_basis, mel_spectrogram))
+	return np.maximum(1e-10, np.dot(_get_inv_mel_basis(hparams, mel_spectrogram.dtype), mel_spectrogram))
 
 def _build_mel_basis(hparams):
 	assert hparams.fmax <= hparams.sample_rate // 2
@@ -183,7 +473,8 @@ def _build_mel_basis(hparams):
 							   fmin=hparams.fmin, fmax=hparams.fmax)
 
 def _amp_to_db(x, hparams):
-	min_level = np.exp(hparams.min_level_db / 20 * np.log(10))
+	#A Python float does not promote float32 magnitudes
+	min_level = float(np.exp(hparams.min_level_db / 20 * np.log(10)))
 	return 20 * np.log10(np.maximum(min_level, x))
 
 def _db_to_amp(x):
@@ -230,19 +521,19 @@ def wav2spectrograms(wav, hparams):
 	out = wav
 	constant_values = 0.
 
-	# Compute the mel scale spectrogram from the wav
-	mel_spectrogram = melspectrogram(wav, hparams).astype(np.float32)
-	mel_frames = mel_spectrogram.shape[1]
+	#Run pre-emphasis and the STFT once for both spectrograms
+	analysis = SpectralAnalysis(wav, hparams)
+	mel_frames = analysis.num_frames
 
 	if mel_frames > hparams.max_mel_frames and hparams.clip_mels_length:
 		return None
 
-	#Compute the linear scale spectrogram from the wav
-	linear_spectrogram = linearspectrogram(wav, hparams).astype(np.float32)
-	linear_frames = linear_spectrogram.shape[1]
+	# Compute the mel and linear scale spectrograms from the shared magnitude
+	mel_spectrogram = analysis.mel_spectrogram().astype(np.float32)
+	linear_spectrogram = analysis.linear_spectrogram().astype(np.float32)
 
 	#sanity check
-	assert linear_frames == mel_frames
+	assert linear_spectrogram.shape[1] == mel_spectrogram.shape[1] == mel_frames
 
 	if hparams.use_lws:
 		#Ensure time resolution adjustement between audio and mel-spectrogram
@@ -0,0 +1,97 @@
+import mmap
+import multiprocessing
+import threading
+
+import numpy as np
+
+#Arrays are laid out in the shared memory of the cache at offsets aligned to this many bytes
+_alignment = 64
+
+#States of a cache slot
+_empty, _writing, _ready, _unused = 0, 1, 2, 3
+
+
+class SharedArrayCache:
+	"""
+		In RAM cache of loaded arrays with a byte budget, shared by the processes forked after its creation.
+
+		The arrays that may be requested are known up front (layout: key -> (shape, dtype)). Slots are laid out once
+		for the smallest of them (the short utterances, most of a corpus) until the budget is used, in anonymous shared
+		memory whose pages are only allocated when written. An array is written once into its slot by whichever process
+		loads it first, every process then reads it in place: forked feeder workers share a single copy of every cached
+		array instead of each filling its own. Arrays without a slot are loaded on every request. Thread safe.
+	"""
+
+	def __init__(self, layout, max_bytes):
+		self._slots = {}
+		size = 0
+		for key in sorted(layout, key=lambda key: _nbytes(*layout[key])):
+			shape, dtype = layout[key]
+			nbytes = _nbytes(shape, dtype)
+			if size + nbytes > max_bytes:
+				break
+			self._slots[key] = (len(self._slots), size, tuple(shape), np.dtype(dtype))
+			size += -(-nbytes // _alignment) * _alignment
+
+		#Anonymous mappings are shared with forked children
+		self._buffer = np.frombuffer(mmap.mmap(-1, max(size, 1)), dtype=np.uint8)
+		self._states = np.frombuffer(mmap.mmap(-1, max(len(self._slots), 1)), dtype=np.uint8)
+		self._lock = multiprocessing.Lock()
+		self._count_lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		#Bytes this process wrote into the cache: summed over the processes sharing it, the bytes it holds
+		self.bytes = 0
+
+	def __len__(self):
+		return len(self._slots)
+
+	def get(self, key, load, *args):
+		'''Returns the cached array of key (read only), or load(*args) (written into its slot if it has one)'''
+		slot = self._slots.get(key)
+		if slot is None:
+			self._count(misses=1)
+			return load(*args)
+		number, offset, shape, dtype = slot
+		if self._states[number] == _ready:
+			self._count(hits=1)
+			view = np.ndarray(shape, dtype=dtype, buffer=self._buffer, offset=offset)
+			view.flags.writeable = False
+			return view
+
+		self._count(misses=1)
+		#Only one process writes a slot, the others load the array themselves meanwhile
+		with self._lock:
+			claimed = self._states[number] == _empty
+			if claimed:
+				self._states[number] = _writing
+		if not claimed:
+			return load(*args)
+
+		state = _empty
+		try:
+			value = load(*args)
+			if value.shape != shape or value.dtype != dtype:
+				#Not laid out as expected (e.g. targets of another precision), never cached
+				state = _unused
+				return value
+			np.ndarray(shape, dtype=dtype, buffer=self._buffer, offset=offset)[...] = value
+			self._count(bytes=value.nbytes)
+			state = _ready
+			return value
+		finally:
+			with self._lock:
+				self._states[number] = state
+
+	def stats(self):
+		'''Returns (hits, misses, bytes written) of this process'''
+		return self.hits, self.misses, self.bytes
+
+	def _count(self, **values):
+		with self._count_lock:
+			for name, value in values.items():
+				setattr(self, name, getattr(self, name) + value)
+
+
+def _nbytes(shape, dtype):
+	return int(np.prod(shape)) * np.dtype(dtype).itemsize
@@ -1,12 +1,9 @@
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
-
 import numpy as np
 import os
-from datasets import audio
+from datasets import audio, pipeline, store
 
 
-def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x):
+def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x, manifest=None, resume=False, writer=None, chunk_size=16):
 	"""
 	Preprocesses the LJ speech format dataset from a gven input path to given output directories
 
@@ -22,33 +19,39 @@ def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12,
 		- wav_dir: output directory of the preprocessed speech audio dataset
 		- n_jobs: Optional, number of worker process to parallelize across
 		- tqdm: Optional, provides a nice progress bar
+		- manifest: Optional, manifest of already processed utterances (only new or changed ones are processed)
+		- resume: Optional, whether to reuse manifest entries without checking the source wavs for changes
+		- writer: Optional, MetadataWriter of train.txt the rows are streamed to as utterances complete
+		- chunk_size: Optional, number of utterances handed to a worker process at once
 
 	Returns:
-		- A list of tuple describing the train examples. this should be written to train.txt
+		- The writer if one was given, else a list of tuple describing the train examples. this should be written to train.txt
 	"""
 
-	# We use ProcessPoolExecutor to parallelize across processes, this is just for
-	# optimization purposes and it can be omited
-	executor = ProcessPoolExecutor(max_workers=n_jobs)
-	futures = []
-	index = 1
+	# Utterances are processed in parallel across processes by the pipeline, this is just for
+	# optimization purposes
+	jobs = _list_jobs(input_dir, mel_dir, linear_dir, wav_dir)
+	return pipeline.run(jobs, hparams, n_jobs, tqdm, manifest, resume, writer, chunk_size)
+
+
+def _list_jobs(input_dir, mel_dir, linear_dir, wav_dir):
+	"""
+	Lazily yields the (basename, wav_path, process, args, labels) jobs of the utterances listed in metadata.csv
+	"""
 	with open(os.path.join(input_dir, 'metadata.csv'), encoding='utf-8') as f:
 		for line in f:
 			parts = line.strip().split('|')
 			basename = parts[0]
 			wav_path = os.path.join(input_dir, 'wavs', '{}.wav'.format(basename))
 			text = parts[2]
-			futures.append(executor.submit(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, hparams)))
-			index += 1
-
-	return [future.result() for future in tqdm(futures) if future.result() is not None]
+			yield (basename, wav_path, _process_utterance, (mel_dir, linear_dir, wav_dir, basename, wav_path, text), (text, ))
 
 
 def _process_utterance(mel_dir, linear_dir, wav_dir, index, wav_path, text, hparams):
 	"""
 	Preprocesses a single utterance wav/text pair
 
-	this writes the mel scale spectogram to disk and return a tuple to write
+	this writes the mel scale spectogram to disk (as .npy files or into shards, see hparams.training_data_format) and return a tuple to write
 	to the train.txt file
 
 	Args:
@@ -93,9 +96,9 @@ def _process_utterance(mel_dir, linear_dir, wav_dir, index, wav_path, text, hpar
 	audio_filename = 'audio-{}.npy'.format(index)
 	mel_filename = 'mel-{}.npy'.format(index)
 	linear_filename = 'linear-{}.npy'.format(index)
-	np.save(os.path.join(wav_dir, audio_filename), out.astype(np.float32), allow_pickle=False)
-	np.save(os.path.join(mel_dir, mel_filename), mel_spectrogram.T, allow_pickle=False)
-	np.save(os.path.join(linear_dir, linear_filename), linear_spectrogram.T, allow_pickle=False)
+	store.save(wav_dir, audio_filename, out.astype(np.float32), hparams)
+	store.save(mel_dir, mel_filename, mel_spectrogram.T, hparams)
+	store.save(linear_dir, linear_filename, linear_spectrogram.T, hparams)
 
 	# Return a tuple describing this training example
 	return (audio_filename, mel_filename, linear_filename, time_steps, mel_frames, text)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+
+#Hyper parameters that change the content of the preprocessed training data.
+#Changing any of them invalidates every entry recorded under the previous values.
+_audio_hparams = [
+	'sample_rate', 'n_fft', 'hop_size', 'frame_shift_ms', 'win_size', 'stft_pad_mode', 'num_mels', 'fmin', 'fmax',
+	'preemphasize', 'preemphasis', 'rescale', 'rescaling_max',
+	'trim_silence', 'trim_fft_size', 'trim_hop_size', 'trim_top_db',
+	'signal_normalization', 'allow_clipping_in_normalization', 'symmetric_mels', 'max_abs_value',
+	'min_level_db', 'ref_level_db', 'use_lws', 'dsp_dtype', 'clip_mels_length', 'max_mel_frames', 'training_data_format',
+]
+
+
+def hparams_key(hparams):
+	'''Short digest of the audio relevant hyper parameters'''
+	values = '|'.join(['{}={}'.format(name, getattr(hparams, name)) for name in _audio_hparams])
+	return hashlib.sha1(values.encode('utf-8')).hexdigest()[:16]
+
+def file_hash(path):
+	'''Content digest of a source file'''
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+class Manifest:
+	"""
+		Append-only record of the utterances processed into a training data directory.
+
+		Each line is 'basename|wav_hash|hparams_key|metadata row' (the row is empty for utterances that
+		preprocessing skipped, e.g. too long ones). Entries are appended as soon as an utterance is done, so
+		an interrupted run can be resumed and a later run only needs to process new or changed utterances.
+	"""
+
+	def __init__(self, path, hparams):
+		self._path = path
+		self._key = hparams_key(hparams)
+		self._entries = {}
+
+		stale = False
+		if os.path.isfile(path):
+			with open(path, encoding='utf-8') as f:
+				for line in f:
+					if not line.endswith('\n'):
+						#Torn last line of an interrupted run
+						stale = True
+						continue
+					parts = line.rstrip('\n').split('|')
+					if parts[2] != self._key or parts[0] in self._entries:
+						stale = True
+					if parts[2] == self._key:
+						self._entries[parts[0]] = (parts[1], parts[3:] or None)
+
+		if stale:
+			self._compact()
+		self._file = open(path, 'a', encoding='utf-8')
+
+	def __len__(self):
+		return len(self._entries)
+
+	def lookup(self, basename):
+		'''Returns (wav_hash, metadata row or None) of a processed utterance, None if it was never processed'''
+		return self._entries.get(basename)
+
+	def add(self, basename, wav_hash, row):
+		row = [str(x) for x in row] if row is not None else None
+		self._entries[basename] = (wav_hash, row)
+		self._file.write('|'.join([basename, wav_hash, self._key] + (row or [])) + '\n')
+
+	def flush(self):
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+	def _compact(self):
+		#Drop entries of other hparams and superseded ones
+		tmp_path = self._path + '.tmp'
+		with open(tmp_path, 'w', encoding='utf-8') as f:
+			for basename, (wav_hash, row) in self._entries.items():
+				f.write('|'.join([basename, wav_hash, self._key] + (row or [])) + '\n')
+		os.replace(tmp_path, self._path)
@@ -0,0 +1,189 @@
+'''
+Columnar index of a metadata file (train.txt).
+
+Every field readers need per utterance is stored as one flat numpy array in a 'metadata' directory next to
+train.txt: file names, audio timesteps and mel frames, the raw text (one utf-8 blob with row offsets),
+speaker and language ids, and the shard locations of the mel and linear targets. The columns are memory
+mapped on load, so opening the index of millions of utterances costs neither string parsing nor per row
+python objects, and targets stored in shards are read without going through the shard index files.
+'''
+import json
+import os
+
+import numpy as np
+
+from datasets import store
+from datasets.manifest import file_hash
+
+_index_dir = 'metadata'
+_tag_file = 'index.json'
+
+_columns = [
+	'audio_names', 'mel_names', 'linear_names', 'timesteps', 'mel_frames', 'text_bytes', 'text_offsets',
+	'speakers', 'languages', 'mel_shards', 'mel_offsets', 'linear_shards', 'linear_offsets',
+]
+
+
+class MetadataIndex:
+	"""
+		Read access to the columns of a metadata file, row i is the i-th line of train.txt.
+	"""
+
+	def __init__(self, data_dir, columns, tag):
+		self._data_dir = data_dir
+		self._tag = tag
+		for name in _columns:
+			setattr(self, name, columns[name])
+		self._mel_store = None
+		self._linear_store = None
+
+	def __len__(self):
+		return len(self.mel_frames)
+
+	@property
+	def metadata_hash(self):
+		'''Content digest of the metadata file the index was built from'''
+		return self._tag['metadata']
+
+	@property
+	def shard_names(self):
+		'''Names of the shards the mel and linear targets are read from (empty lists for .npy targets)'''
+		return {kind: list(self._tag['{}_shards'.format(kind)]) for kind in ('mel', 'linear')}
+
+	@property
+	def total_mel_frames(self):
+		return int(self.mel_frames.sum(dtype=np.int64))
+
+	@property
+	def total_timesteps(self):
+		return int(self.timesteps.sum(dtype=np.int64))
+
+	@property
+	def max_text_length(self):
+		return int(np.diff(self.text_offsets).max()) if len(self) else 0
+
+	def text(self, i):
+		return bytes(self.text_bytes[self.text_offsets[i]:self.text_offsets[i + 1]]).decode('utf-8')
+
+	def audio_name(self, i):
+		return self.audio_names[i].decode('utf-8')
+
+	def mel_name(self, i):
+		return self.mel_names[i].decode('utf-8')
+
+	def linear_name(self, i):
+		return self.linear_names[i].decode('utf-8')
+
+	def load_mel(self, i):
+		if self._mel_store is None:
+			self._mel_store = store.open_store(os.path.join(self._data_dir, 'mels'))
+		return self._load(self._mel_store, self._tag['mel_shards'], self.mel_shards[i], self.mel_offsets[i],
+			self.mel_frames[i], self._tag['num_mels'], self.mel_names[i])
+
+	def load_linear(self, i):
+		if self._linear_store is None:
+			self._linear_store = store.open_store(os.path.join(self._data_dir, 'linear'))
+		return self._load(self._linear_store, self._tag['linear_shards'], self.linear_shards[i], self.linear_offsets[i],
+			self.mel_frames[i], self._tag['num_freq'], self.linear_names[i])
+
+	def _load(self, reader, shards, shard, offset, frames, channels, name):
+		if shard < 0:
+			#Stored as a .npy file (or missing from the shard index when the index was built)
+			return reader.load(name.decode('utf-8'))
+		return reader.load_at(shards[shard], int(offset), np.float32, (int(frames), channels))
+
+
+def build(metadata_filename, save=True, linear=True):
+	'''Builds the index of a metadata file from its rows and the shard index files of its mels (and linear) directories
+
+	Without linear, the linear directory is not read: linear spectrograms are then only found by name.
+	'''
+	data_dir = os.path.dirname(metadata_filename)
+	with open(metadata_filename, encoding='utf-8') as f:
+		rows = [line.strip().split('|') for line in f]
+
+	text = bytearray()
+	text_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+	for i, row in enumerate(rows):
+		text += row[5].encode('utf-8')
+		text_offsets[i + 1] = len(text)
+
+	columns = {
+		'audio_names': _names([row[0] for row in rows]),
+		'mel_names': _names([row[1] for row in rows]),
+		'linear_names': _names([row[2] for row in rows]),
+		'timesteps': np.array([int(row[3]) for row in rows], dtype=np.int64),
+		'mel_frames': np.array([int(row[4]) for row in rows], dtype=np.int32),
+		'text_bytes': np.frombuffer(bytes(text), dtype=np.uint8),
+		'text_offsets': text_offsets,
+		#Single speaker datasets (LJSpeech, DataBaker) have no speaker and language columns
+		'speakers': np.array([int(row[6]) if len(row) > 6 else 0 for row in rows], dtype=np.int32),
+		'languages': np.array([int(row[7]) if len(row) > 7 else 0 for row in rows], dtype=np.int32),
+	}
+	tag = {'metadata': file_hash(metadata_filename), 'rows': len(rows)}
+	for kind, directory, column, channels in (('mel', 'mels', 1, 'num_mels'), ('linear', 'linear', 2, 'num_freq')):
+		directory = os.path.join(data_dir, directory) if kind == 'mel' or linear else None
+		shard_ids, shard_names, offsets, tag[channels] = _locate(directory, [row[column] for row in rows], columns['mel_frames'])
+		columns['{}_shards'.format(kind)] = shard_ids
+		columns['{}_offsets'.format(kind)] = offsets
+		tag['{}_shards'.format(kind)] = shard_names
+
+	if save:
+		out_dir = os.path.join(data_dir, _index_dir)
+		os.makedirs(out_dir, exist_ok=True)
+		for name in _columns:
+			np.save(os.path.join(out_dir, name + '.npy'), columns[name], allow_pickle=False)
+		#The tag is written last: an interrupted build is never picked up
+		with open(os.path.join(out_dir, _tag_file), 'w', encoding='utf-8') as f:
+			json.dump(tag, f)
+	return MetadataIndex(data_dir, columns, tag)
+
+
+def load(metadata_filename):
+	'''Loads the index saved next to a metadata file, None if missing or built from another version of the file'''
+	data_dir = os.path.dirname(metadata_filename)
+	index_dir = os.path.join(data_dir, _index_dir)
+	tag_path = os.path.join(index_dir, _tag_file)
+	if not os.path.isfile(tag_path):
+		return None
+	with open(tag_path, encoding='utf-8') as f:
+		tag = json.load(f)
+	if tag.get('metadata') != file_hash(metadata_filename):
+		return None
+	columns = {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r') for name in _columns}
+	return MetadataIndex(data_dir, columns, tag)
+
+
+def load_or_build(metadata_filename, log=print, linear=True):
+	'''Loads the index of a metadata file, building it in memory if preprocessing did not save an up to date one'''
+	index = load(metadata_filename)
+	if index is None:
+		log('No metadata index matching {}, building it now '
+			'(run preprocess.py --encode_text_only to store it)'.format(metadata_filename))
+		index = build(metadata_filename, save=False, linear=linear)
+	return index
+
+
+def _names(names):
+	#Fixed width byte strings: one flat buffer instead of one python object per row
+	return np.array([name.encode('utf-8') for name in names], dtype=np.bytes_) if names else np.zeros(0, dtype='S1')
+
+def _locate(directory, names, frames):
+	'''Returns (shard ids, shard names, offsets, channels) of the named arrays, shard id -1 for arrays outside of any shard (or not looked up)'''
+	shard_ids = np.full(len(names), -1, dtype=np.int32)
+	offsets = np.zeros(len(names), dtype=np.int64)
+	shards = {}
+	channels = None
+	reader = store.open_store(directory) if directory is not None else None
+	if isinstance(reader, store.ShardReader):
+		for i, name in enumerate(names):
+			if name not in reader:
+				continue
+			shard, offset, dtype, shape = reader.entry(name)
+			if np.dtype(dtype) != np.float32 or len(shape) != 2 or shape[0] != frames[i]:
+				continue
+			shard_ids[i] = shards.setdefault(shard, len(shards))
+			offsets[i] = offset
+			channels = shape[1]
+	return shard_ids, sorted(shards, key=shards.get), offsets, channels
+
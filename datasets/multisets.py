@@ -1,13 +1,10 @@
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
-
 import numpy as np
 import os
 import re
-from datasets import audio
+from datasets import audio, pipeline, store
 
 
-def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x):
+def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12, tqdm=lambda x: x, manifest=None, resume=False, writer=None, chunk_size=16):
   """
   Preprocesses the MultiSets dataset from a gven input path to given output directories
 
@@ -30,15 +27,25 @@ def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12,
     - wav_dir: output directory of the preprocessed speech audio dataset
     - n_jobs: Optional, number of worker process to parallelize across
     - tqdm: Optional, provides a nice progress bar
+    - manifest: Optional, manifest of already processed utterances (only new or changed ones are processed)
+    - resume: Optional, whether to reuse manifest entries without checking the source wavs for changes
+    - writer: Optional, MetadataWriter of train.txt the rows are streamed to as utterances complete
+    - chunk_size: Optional, number of utterances handed to a worker process at once
 
   Returns:
-    - A list of tuple describing the train examples. This should be written to train.txt
+    - The writer if one was given, else a list of tuple describing the train examples. This should be written to train.txt
   """
 
-  # We use ProcessPoolExecutor to parallelize across processes, this is just for
-  # optimization purposes and it can be omited
-  executor = ProcessPoolExecutor(max_workers=n_jobs)
-  futures = []
+  # Utterances are processed in parallel across processes by the pipeline, this is just for
+  # optimization purposes
+  jobs = _list_jobs(input_dir, mel_dir, linear_dir, wav_dir)
+  return pipeline.run(jobs, hparams, n_jobs, tqdm, manifest, resume, writer, chunk_size)
+
+
+def _list_jobs(input_dir, mel_dir, linear_dir, wav_dir):
+  """
+  Lazily yields the (basename, wav_path, process, args, labels) jobs of the utterances of all datasets
+  """
   with open(os.path.join(input_dir, 'metadata.csv'), encoding='utf-8') as f:
     for line in f:
       parts = line.strip().split('|')
@@ -52,9 +59,8 @@ def build_from_path(hparams, input_dir, mel_dir, linear_dir, wav_dir, n_jobs=12,
       for basename, text in metadata:
         wav_path = os.path.join(wavs_dir, '{}.wav'.format(basename))
         basename = base_prefix + basename
-        futures.append(executor.submit(partial(_process_utterance, mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_id, language_id, hparams)))
-
-  return [future.result() for future in tqdm(futures) if future.result() is not None]
+        yield (basename, wav_path, _process_utterance, (mel_dir, linear_dir, wav_dir, basename, wav_path, text, speaker_id, language_id),
+          (text, speaker_id, language_id))
 
 
 def _load_metadata(path, use_raw):
@@ -73,7 +79,7 @@ def _process_utterance(mel_dir, linear_dir, wav_dir, index, wav_path, text, spea
   """
   Preprocesses a single utterance wav/text pair
 
-  This writes the mel scale spectogram to disk and return a tuple to write to the train.txt file
+  This writes the mel scale spectogram to disk (as .npy files or into shards, see hparams.training_data_format) and return a tuple to write to the train.txt file
 
   Args:
     - mel_dir: the directory to write the mel spectograms into
@@ -114,9 +120,9 @@ def _process_utterance(mel_dir, linear_dir, wav_dir, index, wav_path, text, spea
   audio_filename = 'audio-{}.npy'.format(index)
   mel_filename = 'mel-{}.npy'.format(index)
   linear_filename = 'linear-{}.npy'.format(index)
-  np.save(os.path.join(wav_dir, audio_filename), out.astype(np.float32), allow_pickle=False)
-  np.save(os.path.join(mel_dir, mel_filename), mel_spectrogram.T, allow_pickle=False)
-  np.save(os.path.join(linear_dir, linear_filename), linear_spectrogram.T, allow_pickle=False)
+  store.save(wav_dir, audio_filename, out.astype(np.float32), hparams)
+  store.save(mel_dir, mel_filename, mel_spectrogram.T, hparams)
+  store.save(linear_dir, linear_filename, linear_spectrogram.T, hparams)
 
   # Return a tuple describing this training example
   return (audio_filename, mel_filename, linear_filename, time_steps, mel_frames, text, speaker, language)
@@ -0,0 +1,203 @@
+import collections
+import multiprocessing
+import queue
+import time
+
+from datasets import audio
+from datasets.manifest import file_hash
+
+#Seconds between two flushes of train.txt and of the manifest
+_flush_secs = 5
+
+#Hyper parameters of a worker process, set once by its initializer
+_hparams = None
+
+#Leading fields of a metadata row that preprocessing the wav yields (audio, mel and linear names, time steps, mel frames),
+#the following ones (text, speaker, language...) come from the source metadata
+_audio_fields = 5
+
+
+class MetadataWriter:
+	"""
+		Appends metadata rows to train.txt as they arrive.
+	"""
+
+	def __init__(self, path):
+		self._file = open(path, 'w', encoding='utf-8')
+
+	def write(self, row):
+		self._file.write('|'.join([str(x) for x in row]) + '\n')
+
+	def flush(self):
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+
+def run(jobs, hparams, n_jobs=12, tqdm=lambda x: x, manifest=None, resume=False, writer=None, chunk_size=16, max_in_flight=None):
+	"""
+	Preprocesses utterances in a pool of worker processes, reusing the results recorded in the manifest
+
+	Utterances recorded in the manifest are only processed again if their source wav changed
+	(or not at all in resume mode). Only the audio fields of their recorded row are reused, the labels (text,
+	speaker, language) are those of the current job, so that edited transcripts or ids are picked up. Work is handed out in chunks of chunk_size utterances to workers that
+	received hparams and the mel basis once at startup, which keeps pickling and scheduling costs per
+	utterance low. At most max_in_flight chunks are in flight at a time and results are collected in job
+	order (chunks finishing early wait for the ones before them): rows are written in the same order on every
+	run, and every collected utterance is recorded in the manifest and its row is handed to the writer right
+	away, so memory stays flat and an interrupted run only loses the chunks in flight.
+
+	Args:
+		- jobs: iterable of (basename, wav_path, process, args, labels) where process(*args, hparams) preprocesses the utterance and returns its metadata row (or None),
+		  which ends with the labels. process must be a module level function.
+		- hparams: hyper parameters
+		- n_jobs: Optional, number of worker process to parallelize across
+		- tqdm: Optional, provides a nice progress bar
+		- manifest: Optional, manifest of the output directory
+		- resume: Optional, whether to reuse manifest entries without checking the source wavs for changes
+		- writer: Optional, MetadataWriter the rows are streamed to
+		- chunk_size: Optional, number of utterances sent to a worker at once
+		- max_in_flight: Optional, maximal number of submitted and not yet collected chunks (Default: 4 * n_jobs)
+
+	Returns:
+		- The writer if one was given, else a list of tuple describing the train examples
+	"""
+	metadata = []
+	emit = writer.write if writer is not None else metadata.append
+	max_in_flight = max_in_flight or 4 * n_jobs
+	last_flush = time.time()
+
+	mel_basis = audio.init_mel_basis(hparams)
+	with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(hparams, mel_basis)) as pool:
+		for basename, labels, entry, (wav_hash, changed, row) in tqdm(_completed(pool, jobs, manifest, resume, chunk_size, max_in_flight)):
+			if not changed:
+				row = _relabel(entry[1], labels)
+				if row != entry[1]:
+					manifest.add(basename, wav_hash, row)
+			elif wav_hash is not None and manifest is not None:
+				manifest.add(basename, wav_hash, row)
+
+			if row is not None:
+				emit(row)
+
+			if time.time() - last_flush > _flush_secs:
+				_flush(writer, manifest)
+				last_flush = time.time()
+
+	_flush(writer, manifest)
+	return writer if writer is not None else metadata
+
+
+def _completed(pool, jobs, manifest, resume, chunk_size, max_in_flight):
+	'''Submits jobs in chunks while keeping at most max_in_flight chunks in flight, yields (basename, labels, manifest entry, result) in job order'''
+	#Finished chunks are put there by the result handler thread of the pool, with their submission number
+	done = queue.Queue()
+	#Chunks in job order: the results of reused utterances, the submission number of submitted chunks
+	order = collections.deque()
+	finished = {}
+	submitted = 0
+	in_flight = 0
+	chunk = []
+
+	def ready():
+		#Results at the head of order that are known. Chunks finished out of order count as in flight until yielded
+		nonlocal in_flight
+		while order and (isinstance(order[0], list) or order[0] in finished):
+			head = order.popleft()
+			if isinstance(head, list):
+				yield from head
+			else:
+				in_flight -= 1
+				yield from _collect(finished.pop(head))
+
+	for basename, wav_path, process, args, labels in jobs:
+		entry = manifest.lookup(basename) if manifest is not None else None
+		if entry is not None and resume:
+			#Reused utterances keep their place: after the utterances of the chunk being filled
+			if chunk:
+				chunk.append((basename, labels, entry, None))
+			else:
+				order.append([(basename, labels, entry, _reused(entry))])
+				yield from ready()
+			continue
+
+		known_hash = entry[0] if entry is not None else None
+		chunk.append((basename, labels, entry, (process, args, wav_path, known_hash, manifest is not None)))
+		if sum([task is not None for _, _, _, task in chunk]) < chunk_size:
+			continue
+
+		_submit(pool, done, submitted, chunk)
+		order.append(submitted)
+		submitted += 1
+		in_flight += 1
+		chunk = []
+		#Collects what finished so far, waits for chunks while too many are in flight
+		while in_flight >= max_in_flight or not done.empty():
+			_receive(done, finished)
+			yield from ready()
+
+	if chunk:
+		_submit(pool, done, submitted, chunk)
+		order.append(submitted)
+	while order:
+		yield from ready()
+		if order:
+			_receive(done, finished)
+
+def _submit(pool, done, number, chunk):
+	keys = [(basename, labels, entry, task is None) for basename, labels, entry, task in chunk]
+	pool.apply_async(_process_chunk, ([task for _, _, _, task in chunk if task is not None], ),
+		callback=lambda results: done.put((number, (keys, results, None))),
+		error_callback=lambda error: done.put((number, (keys, None, error))))
+
+def _receive(done, finished):
+	number, chunk = done.get()
+	finished[number] = chunk
+
+def _collect(finished):
+	keys, results, error = finished
+	if error is not None:
+		raise error
+	results = iter(results)
+	for basename, labels, entry, reused in keys:
+		yield basename, labels, entry, _reused(entry) if reused else next(results)
+
+def _reused(entry):
+	#Result of an utterance taken from the manifest (wav_hash, changed, row): run() uses the recorded row
+	return entry[0], False, None
+
+def _relabel(row, labels):
+	#Recorded row (None for skipped utterances) with the labels of the current job
+	if row is None:
+		return None
+	return [str(x) for x in row[:_audio_fields]] + [str(x) for x in labels]
+
+def _flush(writer, manifest):
+	if writer is not None:
+		writer.flush()
+	if manifest is not None:
+		manifest.flush()
+
+def _init_worker(hparams, mel_basis):
+	global _hparams
+	_hparams = hparams
+	audio.init_mel_basis(hparams, mel_basis)
+
+def _process_chunk(tasks):
+	'''Runs in a worker process, returns the list of (wav_hash, changed, metadata row) of a chunk'''
+	return [_process(*task) for task in tasks]
+
+def _process(process, args, wav_path, known_hash, with_hash):
+	wav_hash = None
+	if with_hash:
+		try:
+			wav_hash = file_hash(wav_path)
+		except FileNotFoundError:
+			#process() reports the missing file
+			pass
+
+		if wav_hash is not None and wav_hash == known_hash:
+			return wav_hash, False, None
+
+	return wav_hash, True, process(*args, _hparams)
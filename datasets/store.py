@@ -0,0 +1,172 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+#Every array is written at an offset aligned to this many bytes so that memory-mapped views stay aligned
+_alignment = 64
+
+#Shard writers opened by the current (worker) process, one per output directory
+_writers = {}
+
+
+class ShardWriter:
+	"""
+		Appends arrays to large contiguous shard files and records (shard, offset, dtype, shape) of each array in an index.
+
+		Every writer owns its own shard and index files (named after a unique tag), so that several
+		preprocessing processes can write into the same directory without any coordination.
+	"""
+
+	def __init__(self, out_dir, max_shard_bytes):
+		self._out_dir = out_dir
+		self._max_shard_bytes = max_shard_bytes
+		self._tag = '{:016x}-{}'.format(int(time.time() * 1e6), os.getpid())
+		self._shard_id = -1
+		self._shard = None
+		self._shard_name = None
+		self._offset = 0
+		self._index = open(os.path.join(out_dir, 'index-{}.txt'.format(self._tag)), 'a', encoding='utf-8')
+
+	def write(self, name, array):
+		array = np.ascontiguousarray(array)
+		if self._shard is None or (self._offset > 0 and self._offset + array.nbytes > self._max_shard_bytes):
+			self._next_shard()
+
+		offset = self._offset
+		padding = -(offset + array.nbytes) % _alignment
+		self._shard.write(array.tobytes())
+		self._shard.write(b'\0' * padding)
+		#Data is flushed before its index entry so that the index never points to missing bytes
+		self._shard.flush()
+		self._offset += array.nbytes + padding
+
+		shape = ','.join([str(x) for x in array.shape])
+		self._index.write('|'.join([name, self._shard_name, str(offset), array.dtype.str, shape]) + '\n')
+		self._index.flush()
+
+	def close(self):
+		if self._shard is not None:
+			self._shard.close()
+			self._shard = None
+		self._index.close()
+
+	def _next_shard(self):
+		if self._shard is not None:
+			self._shard.close()
+		self._shard_id += 1
+		self._shard_name = 'shard-{}-{:05d}.bin'.format(self._tag, self._shard_id)
+		self._shard = open(os.path.join(self._out_dir, self._shard_name), 'wb')
+		self._offset = 0
+
+
+class ShardReader:
+	"""
+		Reads arrays written by ShardWriter through read-only memory maps (one per shard, opened on first use).
+
+		Random access costs one dictionary lookup and one slice of the mapped shard, no file is opened per array.
+		Readers that already know the location of an array (see datasets.metadata) use load_at() and never read the index.
+	"""
+
+	def __init__(self, directory):
+		self._dir = directory
+		self._shards = {}
+		self._entries = None
+
+	def __contains__(self, name):
+		return name in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	@property
+	def entries(self):
+		'''Location (shard, offset, dtype, shape) of every array by name, the index files are only read on first use'''
+		if self._entries is None:
+			self._entries = {}
+			#Index files are named after a time ordered tag: later writes of the same name override earlier ones
+			for index_file in sorted(glob.glob(os.path.join(self._dir, 'index-*.txt'))):
+				with open(index_file, encoding='utf-8') as f:
+					for line in f:
+						parts = line.strip().split('|')
+						if len(parts) != 5:
+							#Torn last line of an interrupted preprocessing run
+							continue
+						name, shard, offset, dtype, shape = parts
+						self._entries[name] = (shard, int(offset), dtype, tuple(int(x) for x in shape.split(',') if x != ''))
+		return self._entries
+
+	def entry(self, name):
+		'''Returns the (shard, offset, dtype, shape) location of an array'''
+		return self.entries[name]
+
+	def load(self, name):
+		return self.load_at(*self.entries[name])
+
+	def load_at(self, shard, offset, dtype, shape):
+		buf = self._shards.get(shard)
+		if buf is None:
+			buf = np.memmap(os.path.join(self._dir, shard), dtype=np.uint8, mode='r')
+			self._shards[shard] = buf
+		dtype = np.dtype(dtype)
+		return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+class NpyReader:
+	"""
+		Reads arrays stored as one .npy file per utterance (the original training data layout).
+	"""
+
+	def __init__(self, directory):
+		self._dir = directory
+
+	def __contains__(self, name):
+		return os.path.isfile(os.path.join(self._dir, name))
+
+	def load(self, name):
+		return np.load(os.path.join(self._dir, name))
+
+
+def open_store(directory):
+	'''Opens a training data directory for reading, whichever layout it was written with'''
+	if glob.glob(os.path.join(directory, 'index-*.txt')):
+		return ShardReader(directory)
+	return NpyReader(directory)
+
+def prune(directory):
+	'''Deletes the shards of a shard directory that no array of its index is read from anymore, returns their number
+
+	Arrays written again by a later preprocessing run override their earlier entries, shards left without any entry
+	are removed along with the index files of their writer once none of its shards remain. Only call this while no
+	writer is appending to the directory.'''
+	index_files = glob.glob(os.path.join(directory, 'index-*.txt'))
+	if not index_files:
+		return 0
+	used = set(shard for shard, _, _, _ in ShardReader(directory).entries.values())
+
+	removed = 0
+	for path in glob.glob(os.path.join(directory, 'shard-*.bin')):
+		if os.path.basename(path) not in used:
+			os.remove(path)
+			removed += 1
+	#Shards are named after the tag of their writer's index file
+	used_tags = set(shard[len('shard-'): shard.rindex('-')] for shard in used)
+	for index_file in index_files:
+		if os.path.basename(index_file)[len('index-'): -len('.txt')] not in used_tags:
+			os.remove(index_file)
+	return removed
+
+def save(out_dir, filename, array, hparams):
+	'''Stores an array under the given name, either as a .npy file or appended to a shard of this process'''
+	if hparams.training_data_format == 'npy':
+		np.save(os.path.join(out_dir, filename), array, allow_pickle=False)
+		return
+	if hparams.training_data_format != 'shards':
+		raise ValueError('Unknown training data format: {}'.format(hparams.training_data_format))
+
+	writer = _writers.get(out_dir)
+	if writer is None:
+		writer = ShardWriter(out_dir, hparams.shard_size_mb * 1024 * 1024)
+		_writers[out_dir] = writer
+	writer.write(filename, array)
@@ -70,6 +70,10 @@ hparams = tf.contrib.training.HParams(
 	clip_mels_length = True, #For cases of OOM (Not really recommended, only use if facing unsolvable OOM errors, also consider clipping your samples to smaller chunks)
 	max_mel_frames = 1000,  #Only relevant when clip_mels_length = True, please only use after trying outputs_per_step=3 and still getting OOM errors.
 
+	#Training data storage
+	training_data_format = 'shards', #How preprocessing stores audio/mel/linear arrays. Can be ('npy': one file per utterance, or 'shards': large memory-mappable files + offset index)
+	shard_size_mb = 1024, #Maximal size of a single shard file in MB (Only relevant if training_data_format='shards')
+
 	# Use LWS (https://github.com/Jonathan-LeRoux/lws) for STFT and phase reconstruction
 	# It's preferred to set True to use with https://github.com/r9y9/wavenet_vocoder
 	# Does not work if n_ffit is not multiple of hop_size!!
@@ -82,6 +86,9 @@ hparams = tf.contrib.training.HParams(
 	win_size = 1100, #For 22050Hz, 1100 ~= 50 ms (If None, win_size = n_fft) (0.05 * sample_rate)
 	sample_rate = 22050, #22050 Hz (corresponding to ljspeech dataset) (sox --i <filename>)
 	frame_shift_ms = None, #Can replace hop_size parameter. (Recommended: 12.5)
+	stft_pad_mode = 'reflect', #Padding of the signal edges for the centered STFT frames (np.pad mode): 'reflect' as librosa < 0.10 (and the audio padding of wav2spectrograms), 'constant' as librosa >= 0.10
+	dsp_dtype = 'float64', #Precision of the spectrograms computed in preprocessing and of G&L inversion. 'float32' (complex64 FFTs) halves their memory traffic (see benchmark.py --mode precision)
+	stft_workers = 1, #Number of threads running the FFTs of an STFT (frames are split among them), FFTs release the GIL
 
 	#M-AILABS (and other datasets) trim params (there parameters are usually correct for any data, but definitely must be tuned for specific speakers)
 	trim_fft_size = 512, 
@@ -111,6 +118,9 @@ hparams = tf.contrib.training.HParams(
 	#Griffin Lim
 	power = 1.5, #Only used in G&L inversion, usually values between 1.2 and 1.5 are a good choice.
 	griffin_lim_iters = 60, #Number of G&L iterations, typically 30 is enough but we use 60 to ensure convergence.
+	griffin_lim_momentum = 0., #Momentum of fast G&L (Perraudin et al., 2013), 0 runs the original G&L. 0.99 usually matches the convergence of 60 original iterations in a fraction of them (see benchmark.py --mode griffin_lim)
+	griffin_lim_batch_size = 16, #Number of spectrograms G&L inverts at once when given several (e.g. a synthesis batch), larger groups use more memory
+	griffin_lim_tolerance = None, #If not None, G&L stops before griffin_lim_iters once an iteration improves the spectral convergence by less than this fraction (e.g. 1e-3)
 	###########################################################################################################################################
 
 	#Tacotron
@@ -242,9 +252,15 @@ hparams = tf.contrib.training.HParams(
 
 	#performance parameters
 	tacotron_swap_with_cpu = False, #Whether to use cpu as support to gpu for decoder computation (Not recommended: may cause major slowdowns! Only use when critical!)
+	tacotron_feeder_workers = 4, #Number of processes loading and padding training batches, also the parallelism of the input pipeline (0 builds them in an input pipeline thread)
+	tacotron_feeder_prefetch = 8, #Number of training batches the input pipeline prepares ahead of the training loop
+	tacotron_stage_batches = True, #Whether to copy the next training batch to the GPUs while the current step runs (set to False on CPU only hosts, where it only holds one extra batch)
+	tacotron_cache_mb = 0, #RAM budget (in MB) to keep loaded training targets across epochs, shared by the feeder workers (0 disables the cache). Short utterances are kept first
 
 	#train/test split ratios, mini-batches sizes
 	tacotron_batch_size = 32, #number of training samples on each training steps
+	tacotron_batch_frames = None, #If not None, training batches hold as many samples as fit in this many padded mel frames (batch size * longest mel) instead of tacotron_batch_size (e.g. 32 * 600)
+	tacotron_batch_tokens = None, #If not None (and tacotron_batch_frames is set), also limits training batches to this many padded input tokens (batch size * longest text)
 	#Tacotron Batch synthesis supports ~16x the training batch size (no gradients during testing). 
 	#Training Tacotron with unmasked paddings makes it aware of them, which makes synthesis times different from training. We thus recommend masking the encoder.
 	tacotron_synthesis_batch_size = 1, #DO NOT MAKE THIS BIGGER THAN 1 IF YOU DIDN'T TRAIN TACOTRON WITH "mask_encoder=True"!!
@@ -4,24 +4,31 @@ from multiprocessing import cpu_count
 
 from hparams import hparams
 from tqdm import tqdm
+from datasets import metadata, store
+from datasets.manifest import Manifest
+from datasets.pipeline import MetadataWriter
+from tacotron.utils import encoded_text
 from datasets import ljspeech
 from datasets import databaker
 from datasets import multisets
 
 
-def write_metadata(metadata, out_dir):
-	with open(os.path.join(out_dir, 'train.txt'), 'w', encoding='utf-8') as f:
-		for m in metadata:
-			f.write('|'.join([str(x) for x in m]) + '\n')
-	mel_frames = sum([int(m[4]) for m in metadata])
-	timesteps = sum([int(m[3]) for m in metadata])
+def write_metadata(metadata_filename):
+	'''Builds the columnar index of train.txt (its rows were appended while preprocessing) and reports the corpus statistics'''
+	index = metadata.build(metadata_filename)
 	sr = hparams.sample_rate
-	hours = timesteps / sr / 3600
+	hours = index.total_timesteps / sr / 3600
 	print('Write {} utterances, {} mel frames, {} audio timesteps, ({:.2f} hours)'.format(
-		len(metadata), mel_frames, timesteps, hours))
-	print('Max input length (text chars): {}'.format(max(len(m[5]) for m in metadata)))
-	print('Max mel frames length: {}'.format(max(int(m[4]) for m in metadata)))
-	print('Max audio timesteps length: {}'.format(max(m[3] for m in metadata)))
+		len(index), index.total_mel_frames, index.total_timesteps, hours))
+	print('Max input length (text bytes): {}'.format(index.max_text_length))
+	print('Max mel frames length: {}'.format(int(index.mel_frames.max()) if len(index) else 0))
+	print('Max audio timesteps length: {}'.format(int(index.timesteps.max()) if len(index) else 0))
+
+
+def encode_text(metadata_filename, hparams, n_jobs):
+	'''Stores the symbol ids of every train.txt row next to it, so that training never runs the text cleaners'''
+	text = encoded_text.encode_metadata(metadata_filename, hparams, n_jobs)
+	print('Encoded the text of {} utterances with cleaners \'{}\' ({} symbols)'.format(len(text), hparams.cleaners, hparams.symbols_lang))
 
 
 def main():
@@ -33,6 +40,11 @@ def main():
 	parser.add_argument('--dataset', default='MultiSets')
 	parser.add_argument('--output', default='training_data')
 	parser.add_argument('--n_jobs', type=int, default=cpu_count())
+	parser.add_argument('--resume', action='store_true',
+		help='Continue an interrupted run: utterances recorded in the manifest are reused without checking their wavs for changes')
+	parser.add_argument('--chunk_size', type=int, default=16, help='Number of utterances handed to a worker process at once')
+	parser.add_argument('--encode_text_only', action='store_true',
+		help='Only (re)build the metadata index and pre-tokenized text of an existing train.txt, e.g. after changing cleaners')
 	args = parser.parse_args()
 
 	modified_hp = hparams.parse(args.hparams)
@@ -46,21 +58,41 @@ def main():
 	os.makedirs(mel_dir, exist_ok=True)
 	os.makedirs(wav_dir, exist_ok=True)
 	os.makedirs(lin_dir, exist_ok=True)
+	metadata_filename = os.path.join(out_dir, 'train.txt')
+
+	if args.encode_text_only:
+		write_metadata(metadata_filename)
+		encode_text(metadata_filename, modified_hp, args.n_jobs)
+		return
 	
-	# Process dataset
-	metadata = []
+	# Utterances already processed with the same audio hparams are only processed again if their wav changed
+	manifest = Manifest(os.path.join(out_dir, 'manifest.txt'), modified_hp)
+	print('Found {} utterances in the manifest'.format(len(manifest)))
+
+	# Process dataset, rows are appended to 'train.txt' for training as utterances complete
+	writer = MetadataWriter(metadata_filename)
 	if args.dataset == 'LJSpeech-1.1':
-		metadata = ljspeech.build_from_path(modified_hp, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
+		ljspeech.build_from_path(modified_hp, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm,
+			manifest=manifest, resume=args.resume, writer=writer, chunk_size=args.chunk_size)
 	elif args.dataset == 'DataBaker':
 		use_prosody = True
-		metadata = databaker.build_from_path(modified_hp, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
+		databaker.build_from_path(modified_hp, in_dir, use_prosody, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm,
+			manifest=manifest, resume=args.resume, writer=writer, chunk_size=args.chunk_size)
 	elif args.dataset == 'MultiSets':
-		metadata = multisets.build_from_path(modified_hp, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm)
+		multisets.build_from_path(modified_hp, in_dir, mel_dir, lin_dir, wav_dir, args.n_jobs, tqdm=tqdm,
+			manifest=manifest, resume=args.resume, writer=writer, chunk_size=args.chunk_size)
 	else:
 		raise ValueError('Unsupported dataset provided: {} '.format(args.dataset))
-	
-	# Write metadata to 'train.txt' for training
-	write_metadata(metadata, out_dir)
+	manifest.close()
+	writer.close()
+
+	if modified_hp.training_data_format == 'shards':
+		#Shards of utterances processed again (or of an earlier audio setting) are no longer referenced
+		removed = sum(store.prune(directory) for directory in (mel_dir, lin_dir, wav_dir))
+		print('Removed {} unreferenced shards'.format(removed))
+
+	write_metadata(metadata_filename)
+	encode_text(metadata_filename, modified_hp, args.n_jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,415 @@
+import atexit
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import weakref
+
+import numpy as np
+from datasets import store
+from datasets.cache import SharedArrayCache
+
+#Arrays of a batch are laid out in shared memory at offsets aligned to this many bytes
+_alignment = 64
+
+_eval_tag_file = 'eval_cache.json'
+
+#Shared memory blocks per worker process in the pool: one being filled, one held by the parallel map until its turn
+_blocks_per_worker = 2
+
+#Shared memory blocks are files of this (RAM backed) directory, mapped by the workers and the parent
+_block_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+#Counters of the batches built by a process (see BatchBuilder.stats)
+_stat_names = ['batches', 'examples', 'bytes_read', 'tokenize_time', 'load_time', 'pad_time']
+
+
+class BatchBuilder:
+	"""
+		Loads the examples of a batch and pads them into the arrays fed to the model.
+	"""
+
+	def __init__(self, metadata, text, hparams):
+		self._metadata = metadata
+		self._text = text
+		self._hparams = hparams
+		#Linear spectrograms are only read when the model is trained to predict them
+		self._linear = hparams.predict_linear
+		#Loaded targets kept in RAM, shared with the feeder workers forked later on
+		cache_bytes = hparams.tacotron_cache_mb * 1024 * 1024
+		self.cache = SharedArrayCache(self._target_layout(), cache_bytes) if cache_bytes > 0 else None
+		self._stats = dict.fromkeys(_stat_names, 0)
+		self._stats_lock = threading.Lock()
+
+		#pad input sequences with the <pad_token> 0 ( _ )
+		self._pad = 0
+		#explicitely setting the padding to a value that doesn't originally exist in the spectogram
+		#to avoid any possible conflicts, without affecting the output range of the model too much
+		if hparams.symmetric_mels:
+			self._target_pad = -hparams.max_abs_value
+		else:
+			self._target_pad = 0.
+
+	def example(self, index, cached=True):
+		"""Gets a single example (input, speaker, language, mel_target, linear_target or None, mel_length) from the cache or disk
+		"""
+		return self._example(self._text[index], index, cached)
+
+	def build(self, indices, outputs_per_step, allocate=None, cached=True):
+		start = time.time()
+		inputs = [self._text[index] for index in indices]
+		tokenized = time.time()
+		examples = [self._example(input_data, index, cached) for input_data, index in zip(inputs, indices)]
+		loaded = time.time()
+		outputs = self.prepare(examples, outputs_per_step, allocate)
+		self._count(batches=1, examples=len(examples), tokenize_time=tokenized - start, load_time=loaded - tokenized,
+			pad_time=time.time() - loaded)
+		return outputs
+
+	def stats(self):
+		"""Returns the counters of the batches built by this process
+
+		batches, examples, bytes_read (targets read from disk, cache hits excluded), seconds spent getting the input
+		symbols (tokenize_time), reading targets (load_time) and padding them into the batch arrays (pad_time), and the
+		cache_hits, cache_misses and cache_bytes (written into the shared cache) of the example cache. Targets stored in shards are memory mapped:
+		their pages are only read from disk while being copied into the batch, in pad_time.
+		"""
+		with self._stats_lock:
+			stats = dict(self._stats)
+		stats['cache_hits'], stats['cache_misses'], stats['cache_bytes'] = self.cache.stats() if self.cache is not None else (0, 0, 0)
+		return stats
+
+	def _example(self, input_data, index, cached):
+		mel_target = self._load('mel', self._metadata.load_mel, index, cached)
+		linear_target = self._load('linear', self._metadata.load_linear, index, cached) if self._linear else None
+
+		speaker_label = self._metadata.speakers[index]
+		language_label = self._metadata.languages[index]
+		return (input_data, speaker_label, language_label, mel_target, linear_target, len(mel_target))
+
+	def _target_layout(self):
+		#Shapes and dtypes of the targets, known from the metadata without reading them
+		frames = self._metadata.mel_frames
+		layout = {('mel', i): ((int(frames[i]), self._hparams.num_mels), np.float32) for i in range(len(frames))}
+		if self._linear:
+			layout.update({('linear', i): ((int(frames[i]), self._hparams.num_freq), np.float32) for i in range(len(frames))})
+		return layout
+
+	def _load(self, kind, load, index, cached):
+		if self.cache is None or not cached:
+			return self._read(load, index)
+		return self.cache.get((kind, int(index)), self._read, load, index)
+
+	def _read(self, load, index):
+		array = load(index)
+		self._count(bytes_read=array.nbytes)
+		return array
+
+	def _count(self, **values):
+		with self._stats_lock:
+			for name, value in values.items():
+				self._stats[name] += value
+
+	def prepare(self, batches, outputs_per_step, allocate=None):
+		"""Pads examples into the arrays fed to the model
+
+		The batch is split in one block of examples per GPU, each padded to its own (rounded up) maximal length,
+		and the blocks are laid out next to each other along the time axis. Every example is written straight
+		into its place in the output arrays, obtained from allocate(shapes, dtypes) (new arrays by default).
+
+		Returns:
+			- (inputs, input_lengths, speaker_labels, language_labels, mel_targets, linear_targets, targets_lengths, split_infos)
+			  without linear_targets if the model does not predict linear spectrograms
+			  (<stop_token> targets are derived from targets_lengths by the model)
+		"""
+		num_gpus = self._hparams.tacotron_num_gpus
+		assert 0 == len(batches) % num_gpus
+		size_per_device = len(batches) // num_gpus
+		np.random.shuffle(batches)
+		devices = [batches[size_per_device*i:size_per_device*(i+1)] for i in range(num_gpus)]
+
+		input_max_lens = [max([len(x[0]) for x in device]) for device in devices]
+		target_max_lens = [_round_up(max([x[-1] for x in device]), outputs_per_step) for device in devices]
+
+		n = len(batches)
+		input_len = sum(input_max_lens)
+		target_len = sum(target_max_lens)
+		shapes = [(size_per_device, input_len), (n, ), (n, ), (n, ), (size_per_device, target_len, self._hparams.num_mels),
+			(size_per_device, target_len, self._hparams.num_freq), (n, ), (num_gpus, 3)]
+		dtypes = [np.int32, np.int32, np.int32, np.int32, np.float32, np.float32, np.int32, np.int32]
+		if not self._linear:
+			del shapes[5], dtypes[5]
+		outputs = (allocate or _allocate)(shapes, dtypes)
+		if self._linear:
+			inputs, input_lengths, speaker_labels, language_labels, mel_targets, linear_targets, targets_lengths, split_infos = outputs
+		else:
+			inputs, input_lengths, speaker_labels, language_labels, mel_targets, targets_lengths, split_infos = outputs
+
+		targets_lengths[:] = [x[-1] for x in batches] #Used to mask loss
+		input_lengths[:] = [len(x[0]) for x in batches]
+		speaker_labels[:] = [x[1] for x in batches]
+		language_labels[:] = [x[2] for x in batches]
+
+		input_offset = 0
+		target_offset = 0
+		for i, device in enumerate(devices):
+			input_end = input_offset + input_max_lens[i]
+			target_end = target_offset + target_max_lens[i]
+			for row, (input_data, _, _, mel_target, linear_target, length) in enumerate(device):
+				input_length = len(input_data)
+				inputs[row, input_offset:input_offset+input_length] = input_data
+				inputs[row, input_offset+input_length:input_end] = self._pad
+				mel_targets[row, target_offset:target_offset+length] = mel_target
+				mel_targets[row, target_offset+length:target_end] = self._target_pad
+				if self._linear:
+					linear_targets[row, target_offset:target_offset+length] = linear_target
+					linear_targets[row, target_offset+length:target_end] = self._target_pad
+			split_infos[i] = [input_max_lens[i], target_max_lens[i], target_max_lens[i]]
+			input_offset = input_end
+			target_offset = target_end
+
+		return outputs
+
+
+class BatchWorkers:
+	"""
+		Builds batches in worker processes and hands them over through shared memory.
+
+		Every worker loads and pads whole batches with its own BatchBuilder, straight into a block taken from a pool of
+		shared memory blocks (so a batch is never pickled between processes). Blocks are files of /dev/shm memory mapped
+		by the workers and the parent, removed by the parent when it exits. build() returns views into the block, which
+		goes back to the pool once the last of them is freed (e.g. once the session is done with the batch), and only
+		grows (into a new file) when a batch does not fit. The pool holds held_batches blocks on top of those the
+		workers need: the number of built batches the consumer may keep alive at once (prefetched or staged batches).
+		build() can be called from several threads at once (e.g. a parallel tf.data map), every call keeps one worker busy.
+	"""
+
+	def __init__(self, builder, num_workers, held_batches=0):
+		#Workers are forked: they share the memory mapped metadata, text and shards of the parent for free
+		context = multiprocessing.get_context('fork')
+		self._block_prefix = os.path.join(_block_dir, 'tacotron-feeder-{}'.format(os.getpid()))
+		self._tasks = context.Queue()
+		self._results = context.Queue()
+		self._free_blocks = context.Queue()
+		for _ in range(num_workers * _blocks_per_worker + held_batches):
+			#None: a worker allocates the block on first use
+			self._free_blocks.put(None)
+		self._workers = []
+		for i in range(num_workers):
+			self._workers.append(context.Process(target=_worker_loop,
+				args=(builder, self._tasks, self._results, self._free_blocks, '{}-{}'.format(self._block_prefix, i), i),
+				name='feeder_worker_{}'.format(i), daemon=True))
+		self._lock = threading.Lock()
+		self._next_id = 0
+		self._pending = {}
+		#Blocks mapped in this process, by path
+		self._blocks = {}
+		self._stats = {}
+
+		#Workers are forked right away: create BatchWorkers before any session starts threads (or a CUDA context)
+		for worker in self._workers:
+			worker.start()
+		atexit.register(self._unlink_blocks)
+
+	def start(self):
+		'''Starts handing results of the workers to build() calls'''
+		thread = threading.Thread(name='feeder_results', target=self._dispatch_results)
+		thread.daemon = True
+		thread.start()
+
+	def build(self, indices, outputs_per_step):
+		'''Builds the padded arrays of a batch in a worker process, returns read only views of them in shared memory'''
+		slot = queue.Queue(1)
+		with self._lock:
+			task_id = self._next_id
+			self._next_id += 1
+			self._pending[task_id] = slot
+		self._tasks.put((task_id, indices, outputs_per_step))
+
+		result = slot.get()
+		if isinstance(result, str):
+			raise RuntimeError('Feeder worker failed:\n{}'.format(result))
+		worker, path, replaced, layout, stats = result
+		with self._lock:
+			self._stats[worker] = stats
+			#Blocks a worker outgrew are already removed, only the mapping is left to drop
+			for old in replaced:
+				self._blocks.pop(old, None)
+			block = self._blocks.get(path)
+			if block is None:
+				block = self._blocks[path] = np.memmap(path, dtype=np.uint8, mode='r')
+		#The arrays are views of a per batch base array: the block goes back to the pool once all of them are freed
+		batch = block.view(np.ndarray)
+		weakref.finalize(batch, self._free_blocks.put, path)
+		return _views(batch, layout)
+
+	def stats(self):
+		'''Returns the BatchBuilder.stats() counters summed over all workers, as of their last batch (None before the first one)'''
+		with self._lock:
+			stats = list(self._stats.values())
+		return {name: sum([x[name] for x in stats]) for name in stats[0]} if stats else None
+
+	def _dispatch_results(self):
+		while True:
+			try:
+				task_id, result = self._results.get(timeout=1)
+			except queue.Empty:
+				if all(worker.is_alive() for worker in self._workers):
+					continue
+				#Fail every waiting call rather than blocking the input pipeline forever
+				with self._lock:
+					pending, self._pending = self._pending, {}
+				for slot in pending.values():
+					slot.put('A feeder worker died unexpectedly')
+				continue
+			with self._lock:
+				slot = self._pending.pop(task_id)
+			slot.put(result)
+
+	def _unlink_blocks(self):
+		for path in glob.glob(self._block_prefix + '-*'):
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+class EvalCache:
+	"""
+		Padded test batches stored in shards, read back through memory maps.
+	"""
+
+	def __init__(self, directory, num_batches, num_components):
+		self._reader = store.ShardReader(directory)
+		self._num_batches = num_batches
+		self._num_components = num_components
+
+	def __len__(self):
+		return self._num_batches
+
+	def batch(self, i):
+		return [self._reader.load('{}-{}'.format(i, j)) for j in range(self._num_components)]
+
+
+def eval_cache(directory, tag, builder, batches, outputs_per_step, hparams):
+	'''Returns the EvalCache of test batches (lists of example indices), padding them once if no cache matches tag
+
+	Every tag has its own subdirectory of directory (named after a digest of the tag), so that runs sharing the
+	directory keep their caches. A cache is built under a temporary name and renamed into place once complete.'''
+	cache_dir = os.path.join(directory, hashlib.sha1(json.dumps(tag, sort_keys=True).encode('utf-8')).hexdigest()[:16])
+	cached = _eval_cache_tag(cache_dir)
+	if cached is not None and cached['tag'] == tag:
+		return EvalCache(cache_dir, cached['batches'], cached['components'])
+
+	os.makedirs(directory, exist_ok=True)
+	build_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '.tmp-', dir=directory)
+	try:
+		writer = store.ShardWriter(build_dir, hparams.shard_size_mb * 1024 * 1024)
+		components = 0
+		for i, indices in enumerate(batches):
+			#Test examples are read once, keep them out of the example cache (and of the training batch counters)
+			arrays = builder.prepare([builder.example(index, cached=False) for index in indices], outputs_per_step)
+			components = len(arrays)
+			for j, array in enumerate(arrays):
+				writer.write('{}-{}'.format(i, j), array)
+		writer.close()
+		with open(os.path.join(build_dir, _eval_tag_file), 'w', encoding='utf-8') as f:
+			json.dump({'tag': tag, 'batches': len(batches), 'components': components}, f)
+
+		#Stale (unreadable or colliding) files of this tag only are replaced
+		if os.path.isdir(cache_dir) and _eval_cache_tag(cache_dir) != _eval_cache_tag(build_dir):
+			shutil.rmtree(cache_dir, ignore_errors=True)
+		try:
+			os.replace(build_dir, cache_dir)
+		except OSError:
+			#Another process installed the same cache first
+			if _eval_cache_tag(cache_dir) is None:
+				raise
+	finally:
+		shutil.rmtree(build_dir, ignore_errors=True)
+	return EvalCache(cache_dir, len(batches), components)
+
+def _eval_cache_tag(directory):
+	#Content of the tag file of a complete eval cache, None if there is none
+	try:
+		with open(os.path.join(directory, _eval_tag_file), encoding='utf-8') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+class _BlockAllocator:
+	'''Lays the arrays of a batch out in a free shared memory block of the pool, growing it if needed'''
+
+	def __init__(self, free_blocks, prefix):
+		self._free_blocks = free_blocks
+		self._prefix = prefix
+		self._created = 0
+		self._blocks = {}
+		self.block = None
+		self.replaced = []
+		self.layout = None
+
+	def __call__(self, shapes, dtypes):
+		self.layout = []
+		size = 0
+		for shape, dtype in zip(shapes, dtypes):
+			dtype = np.dtype(dtype)
+			self.layout.append((size, dtype.str, shape))
+			size += _round_up(int(np.prod(shape)) * dtype.itemsize, _alignment)
+
+		path = self._free_blocks.get()
+		block = self._blocks.pop(path, None)
+		if block is None and path is not None:
+			#A block created by another worker, the mappings of blocks outgrown since are dropped first
+			for old in [x for x in self._blocks if not os.path.exists(x)]:
+				del self._blocks[old]
+			block = np.memmap(path, dtype=np.uint8, mode='r+')
+		if block is None or len(block) < size:
+			if block is not None:
+				#The parent and other workers may still map it, the memory is only freed once they drop it too
+				del block
+				os.remove(path)
+				self.replaced.append(path)
+			#Leave some headroom so that a block does not grow again for slightly longer batches
+			path = '{}-{}'.format(self._prefix, self._created)
+			self._created += 1
+			block = np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(size + size // 4, 1), ))
+		self._blocks[path] = block
+		self.block = path
+		return _views(block, self.layout)
+
+
+def _worker_loop(builder, tasks, results, free_blocks, prefix, worker):
+	#Forked workers inherit the random state of the parent, give each of them its own
+	np.random.seed(worker + np.random.randint(1 << 30))
+	allocate = _BlockAllocator(free_blocks, prefix)
+	while True:
+		task_id, indices, outputs_per_step = tasks.get()
+		allocate.block = None
+		allocate.replaced = []
+		try:
+			#The views into the block are dropped right away, the block itself stays mapped for reuse
+			builder.build(indices, outputs_per_step, allocate)
+			results.put((task_id, (worker, allocate.block, allocate.replaced, allocate.layout, builder.stats())))
+		except Exception:
+			if allocate.block is not None:
+				free_blocks.put(allocate.block)
+			results.put((task_id, traceback.format_exc()))
+
+def _allocate(shapes, dtypes):
+	return [np.empty(shape, dtype=dtype) for shape, dtype in zip(shapes, dtypes)]
+
+def _views(buf, layout):
+	return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf, offset=offset) for offset, dtype, shape in layout]
+
+def _round_up(x, multiple):
+	remainder = x % multiple
+	return x if remainder == 0 else x + multiple - remainder
@@ -0,0 +1,143 @@
+import copy
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from datasets import audio
+from infolog import log
+from tacotron.feeder import Feeder
+
+#Stages of the input pipeline, in the order a batch goes through them
+_stages = ['sort', 'tokenize', 'load', 'pad', 'enqueue']
+
+
+def feeder_benchmark(args, hparams):
+	"""Measures how fast the Feeder produces training batches on its own, without any model attached
+
+	The training batches are taken off the input pipeline by a trivial consumer that only reads their lengths and
+	shape. After args.warmup batches (filling the prefetch buffer and the worker processes), the next args.batches
+	are timed. Stage times are busy times summed over the processes building batches, in ms per batch.
+	"""
+	input_path = os.path.join(args.base_dir, args.tacotron_input)
+	log('Loading training data from: {}'.format(input_path))
+
+	start = time.time()
+	coord = tf.train.Coordinator()
+	with tf.variable_scope('datafeeder') as scope:
+		feeder = Feeder(coord, input_path, hparams)
+	log('Feeder set up in {:.3f} sec'.format(time.time() - start))
+
+	#Taking the lengths of a batch off the pipeline dequeues the whole batch, no array is copied out of the session
+	fetches = [feeder.targets_lengths, tf.shape(feeder.mel_targets)]
+
+	config = tf.ConfigProto()
+	config.allow_soft_placement = True
+	with tf.Session(config=config) as sess:
+		feeder.start_threads(sess)
+
+		for i in range(args.warmup):
+			sess.run(fetches)
+		before = feeder.pipeline_stats()
+
+		examples = 0
+		real_frames = 0
+		padded_frames = 0
+		start = time.time()
+		for i in range(args.batches):
+			lengths, shape = sess.run(fetches)
+			examples += len(lengths)
+			real_frames += lengths.sum()
+			#Examples of a batch are padded to the summed (per GPU) maximal length
+			padded_frames += shape[0] * shape[1]
+		elapsed = time.time() - start
+		after = feeder.pipeline_stats()
+
+	stats = {name: after[name] - before[name] for name in after}
+	built = max(stats['batches'], 1)
+	log('\nDrained {} batches in {:.3f} sec with {} feeder workers (prefetching {} batches):'.format(
+		args.batches, elapsed, hparams.tacotron_feeder_workers, hparams.tacotron_feeder_prefetch))
+	log('  {:.1f} examples/s, {:.2f} batches/s, {:.1f} examples per batch'.format(
+		examples / elapsed, args.batches / elapsed, examples / max(args.batches, 1)))
+	log('  {:.0f} mel frames/s, {:.1%} padding efficiency'.format(real_frames / elapsed, real_frames / max(padded_frames, 1)))
+	log('  {:.2f} MB/s read from disk, example cache: {:.1%} hit rate'.format(stats['bytes_read'] / elapsed / 1024 / 1024,
+		stats['cache_hits'] / max(stats['cache_hits'] + stats['cache_misses'], 1)))
+	log('  Stage times over {} batches built (ms per batch): {}'.format(stats['batches'],
+		', '.join(['{} {:.2f}'.format(stage, stats[stage + '_time'] * 1000 / built) for stage in _stages])))
+	return stats
+
+def griffin_lim_benchmark(args, hparams):
+	"""Compares the iterations fast Griffin-Lim needs to reach the spectral convergence of the original algorithm
+
+	The magnitude spectrogram of args.wav is inverted with griffin_lim_iters iterations of the original Griffin-Lim,
+	then with as many iterations of fast Griffin-Lim (momentum of args.momentum, or of hparams if set, or 0.99)
+	from the same random phases. Reports the first fast iteration matching the final original spectral convergence.
+	"""
+	wav = audio.load_wav(args.wav, sr=hparams.sample_rate)
+	S = audio.SpectralAnalysis(wav, hparams).magnitude ** hparams.power
+	log('Inverting {} ({} frames) with {} Griffin-Lim iterations'.format(args.wav, S.shape[1], hparams.griffin_lim_iters))
+
+	momentum = args.momentum if args.momentum is not None else (hparams.griffin_lim_momentum or 0.99)
+	results = {}
+	for name, value in (('original', 0.), ('fast', momentum)):
+		hp = copy.copy(hparams)
+		hp.griffin_lim_momentum = value
+		hp.griffin_lim_tolerance = None
+		convergence = []
+		np.random.seed(hparams.tacotron_random_seed)
+		start = time.time()
+		audio.griffin_lim(S, hp, convergence)
+		results[name] = (convergence, time.time() - start)
+
+	target = results['original'][0][-1]
+	seconds_per_iteration = results['original'][1] / hparams.griffin_lim_iters
+	reached = [i for i, error in enumerate(results['fast'][0]) if error <= target]
+	log('  original: spectral convergence {:.4f} after {} iterations ({:.1f} ms per iteration)'.format(
+		target, hparams.griffin_lim_iters, seconds_per_iteration * 1000))
+	for iterations in sorted(set([5, 10, 20, 30, hparams.griffin_lim_iters])):
+		if iterations <= hparams.griffin_lim_iters:
+			log('  after {:3d} iterations: original {:.4f}, fast (momentum {}) {:.4f}'.format(
+				iterations, results['original'][0][iterations], momentum, results['fast'][0][iterations]))
+	if reached:
+		log('  fast Griffin-Lim reaches it after {} iterations: {:.1f}x fewer iterations'.format(reached[0], hparams.griffin_lim_iters / max(reached[0], 1)))
+	else:
+		log('  fast Griffin-Lim does not reach it within {} iterations (final {:.4f})'.format(hparams.griffin_lim_iters, results['fast'][0][-1]))
+	return results
+
+def precision_benchmark(args, hparams):
+	"""Reports the accuracy and speed of the float32 DSP path (dsp_dtype) against the float64 one
+
+	The mel and linear spectrograms of args.wav are computed in both precisions and compared (in the units of the saved
+	spectrograms), then the float64 mel spectrogram is inverted with Griffin-Lim in both precisions from the same random
+	phases. The spectral convergences are measured against the same float64 target magnitude.
+	"""
+	wav = audio.load_wav(args.wav, sr=hparams.sample_rate)
+	log('Analysing and inverting {} in float64 and float32'.format(args.wav))
+
+	results = {}
+	for dtype in ('float64', 'float32'):
+		hp = copy.copy(hparams)
+		hp.dsp_dtype = dtype
+		start = time.time()
+		analysis = audio.SpectralAnalysis(wav, hp)
+		mel, linear = analysis.mel_spectrogram(), analysis.linear_spectrogram()
+		analysis_time = time.time() - start
+		results[dtype] = (hp, mel, linear, analysis_time)
+
+	reference_hp, reference_mel, reference_linear, _ = results['float64']
+	target = audio._mel_magnitude(reference_mel, reference_hp) ** hparams.power
+	for dtype in ('float64', 'float32'):
+		hp, mel, linear, analysis_time = results[dtype]
+		S = audio._mel_magnitude(reference_mel, hp) ** hparams.power
+		np.random.seed(hparams.tacotron_random_seed)
+		start = time.time()
+		y = audio.griffin_lim(S, hp)
+		inversion_time = time.time() - start
+		convergence = audio.spectral_convergence(target, audio._stft(y.astype(np.float64), reference_hp))
+		log('  {}: analysis {:.1f} ms, Griffin-Lim {:.3f} sec ({} iterations), spectral convergence {:.4f}'.format(
+			dtype, analysis_time * 1000, inversion_time, hparams.griffin_lim_iters, convergence))
+		if dtype != 'float64':
+			log('  {} spectrogram errors: mel max {:.2e} mean {:.2e}, linear max {:.2e} mean {:.2e}'.format(dtype,
+				np.abs(mel - reference_mel).max(), np.abs(mel - reference_mel).mean(),
+				np.abs(linear - reference_linear).max(), np.abs(linear - reference_linear).mean()))
+	return results
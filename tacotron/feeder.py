@@ -1,37 +1,46 @@
+import collections
+import hashlib
+import json
 import os
 import threading
 import time
-import traceback
 
 import numpy as np
 import tensorflow as tf
+from datasets import manifest, metadata
 from infolog import log
 from sklearn.model_selection import train_test_split
-from tacotron.utils.text import text_to_sequence
+from tacotron.batching import BatchBuilder, BatchWorkers, eval_cache
+from tacotron.utils import encoded_text
 
 _batches_per_group = 64
 
+#Positions of the last training batches taken by the session, enough to go back over the batches staged on the GPUs
+_consumed_positions = 2
+
 class Feeder:
 	"""
-		Feeds batches of data into queue on a background thread.
+		Feeds batches of data to the model through tf.data input pipelines.
 	"""
 
 	def __init__(self, coordinator, metadata_filename, hparams):
 		super(Feeder, self).__init__()
 		self._coord = coordinator
 		self._hparams = hparams
-		self._cleaner_names = [x.strip() for x in hparams.cleaners.split(',')]
-		self._train_offset = 0
-		self._test_offset = 0
-
-		# Load metadata
-		self._mel_dir = os.path.join(os.path.dirname(metadata_filename), 'mels')
-		self._linear_dir = os.path.join(os.path.dirname(metadata_filename), 'linear')
-		with open(metadata_filename, encoding='utf-8') as f:
-			self._metadata = [line.strip().split('|') for line in f]
-			frame_shift_ms = hparams.hop_size / hparams.sample_rate
-			hours = sum([int(x[4]) for x in self._metadata]) * frame_shift_ms / (3600)
-			log('Loaded metadata for {} examples ({:.2f} hours)'.format(len(self._metadata), hours))
+		self._metadata_filename = metadata_filename
+
+		# Load metadata (columns of train.txt, the targets are read through it)
+		self._metadata = metadata.load_or_build(metadata_filename, log, linear=hparams.predict_linear)
+		frame_shift_ms = hparams.hop_size / hparams.sample_rate
+		hours = self._metadata.total_mel_frames * frame_shift_ms / (3600)
+		log('Loaded metadata for {} examples ({:.2f} hours)'.format(len(self._metadata), hours))
+
+		#Symbol ids of every example, cleaners are only run here if preprocessing did not store them
+		self._text = encoded_text.load(metadata_filename, hparams)
+		if self._text is None:
+			log('No pre-tokenized text matching {} and the current cleaners, encoding it now '
+				'(run preprocess.py --encode_text_only to store it)'.format(metadata_filename))
+			self._text = encoded_text.encode_metadata(metadata_filename, hparams, save=False)
 
 		#Train test split
 		if hparams.tacotron_test_size is None:
@@ -49,226 +58,349 @@ class Feeder:
 		test_indices = test_indices[:len_test_indices]
 		train_indices = np.concatenate([train_indices, extra_test])
 
-		self._train_meta = list(np.array(self._metadata)[train_indices])
-		self._test_meta = list(np.array(self._metadata)[test_indices])
+		self._train_indices = train_indices
+		self._test_indices = test_indices
+
+		#Sampler state at the start of training, replaced by the one saved with a checkpoint when restoring
+		self._sampler = {'seed': hparams.tacotron_random_seed, 'epoch': 0, 'cursor': 0, 'carry': [], 'batch': 0}
+		self._epoch_order = None
+		self._group_states = {}
+		self._consumed = collections.deque(maxlen=_consumed_positions)
+		self._sampling = False
+		#Group states are added by the generator thread while the session takes batches (and checkpoints read them)
+		self._sampler_lock = threading.Lock()
 
-		self.test_steps = len(self._test_meta) // hparams.tacotron_batch_size
+		self.test_steps = len(self._test_indices) // hparams.tacotron_batch_size
 
 		if hparams.tacotron_test_size is None:
 			assert hparams.tacotron_test_batches == self.test_steps
 
-		#pad input sequences with the <pad_token> 0 ( _ )
-		self._pad = 0
-		#explicitely setting the padding to a value that doesn't originally exist in the spectogram
-		#to avoid any possible conflicts, without affecting the output range of the model too much
-		if hparams.symmetric_mels:
-			self._target_pad = -hparams.max_abs_value
-		else:
-			self._target_pad = 0.
-		#Mark finished sequences with 1s
-		self._token_pad = 1.
+		#Input lengths, used to fill batches up to tacotron_batch_tokens
+		self._text_lengths = self._text.lengths()
+
+		self._builder = BatchBuilder(self._metadata, self._text, hparams)
+
+		#Feeder worker processes are forked here, before any session exists: forking a process running session
+		#threads or a CUDA context may deadlock the children or leave them with an unusable CUDA state
+		self._workers = None
+		if hparams.tacotron_feeder_workers > 0:
+			#Batches stay in shared memory until the session is done with them: the prefetched ones, the one being
+			#taken and the one staged on the GPUs
+			held_batches = hparams.tacotron_feeder_prefetch + 2
+			self._workers = BatchWorkers(self._builder, hparams.tacotron_feeder_workers, held_batches)
+		self._test_batches = None
+		#Seconds spent bucketing examples into batches and building batches (workers included) on behalf of the input pipeline
+		self._sort_time = 0.
+		self._build_time = 0.
+		self._built_batches = 0
+		self._build_time_lock = threading.Lock()
+		#Training batches taken from the pipeline, and when the session last took a (train or eval) batch
+		self._consumed_batches = 0
+		self._dequeue_times = {}
+		self._compute_end = 0.
+		self._eval_cache_dir = os.path.join(os.path.dirname(metadata_filename), 'eval_cache')
+
+		#Names, types and shapes of the batch tensors. Linear targets are only part of batches when the model predicts
+		#linear spectrograms. The batch size is left unspecified to be able to feed different batch sizes at eval time.
+		components = [
+			('inputs', tf.int32, (None, None)),
+			('input_lengths', tf.int32, (None, )),
+			('speaker_labels', tf.int32, (None, )),
+			('language_labels', tf.int32, (None, )),
+			('mel_targets', tf.float32, (None, None, hparams.num_mels)),
+			('linear_targets', tf.float32, (None, None, hparams.num_freq)),
+			('targets_lengths', tf.int32, (None, )),
+			('split_infos', tf.int32, (hparams.tacotron_num_gpus, None)),
+		]
+		if not hparams.predict_linear:
+			components = [component for component in components if component[0] != 'linear_targets']
+		self._names = [name for name, _, _ in components]
+		self._types = [dtype for _, dtype, _ in components]
+		self._shapes = [shape for _, _, shape in components]
+		self.linear_targets = None
+		self.eval_linear_targets = None
 
 		with tf.device('/cpu:0'):
-			# Create placeholders for inputs and targets. Don't specify batch size because we want
-			# to be able to feed different batch sizes at eval time.
-			self._placeholders = [
-			tf.placeholder(tf.int32, shape=(None, None), name='inputs'),
-			tf.placeholder(tf.int32, shape=(None, ), name='input_lengths'),
-			tf.placeholder(tf.int32, shape=(None, ), name='speaker_labels'),
-			tf.placeholder(tf.int32, shape=(None, ), name='language_labels'),
-			tf.placeholder(tf.float32, shape=(None, None, hparams.num_mels), name='mel_targets'),
-			tf.placeholder(tf.float32, shape=(None, None), name='token_targets'),
-			tf.placeholder(tf.float32, shape=(None, None, hparams.num_freq), name='linear_targets'),
-			tf.placeholder(tf.int32, shape=(None, ), name='targets_lengths'),
-			tf.placeholder(tf.int32, shape=(hparams.tacotron_num_gpus, None), name='split_infos'),
-			]
-
-			# Create queue for buffering data
-			queue = tf.FIFOQueue(8, [tf.int32, tf.int32, tf.int32, tf.int32, tf.float32, tf.float32, tf.float32, tf.int32, tf.int32], name='input_queue')
-			self._enqueue_op = queue.enqueue(self._placeholders)
-			self.inputs, self.input_lengths, self.speaker_labels, self.language_labels, self.mel_targets, self.token_targets, self.linear_targets, self.targets_lengths, self.split_infos = queue.dequeue()
-
-			self.inputs.set_shape(self._placeholders[0].shape)
-			self.input_lengths.set_shape(self._placeholders[1].shape)
-			self.speaker_labels.set_shape(self._placeholders[2].shape)
-			self.language_labels.set_shape(self._placeholders[3].shape)
-			self.mel_targets.set_shape(self._placeholders[4].shape)
-			self.token_targets.set_shape(self._placeholders[5].shape)
-			self.linear_targets.set_shape(self._placeholders[6].shape)
-			self.targets_lengths.set_shape(self._placeholders[7].shape)
-			self.split_infos.set_shape(self._placeholders[8].shape)
-
-			# Create eval queue for buffering eval data
-			eval_queue = tf.FIFOQueue(1, [tf.int32, tf.int32, tf.int32, tf.int32, tf.float32, tf.float32, tf.float32, tf.int32, tf.int32], name='eval_queue')
-			self._eval_enqueue_op = eval_queue.enqueue(self._placeholders)
-			self.eval_inputs, self.eval_input_lengths, self.eval_speaker_labels, self.eval_language_labels, self.eval_mel_targets, self.eval_token_targets, \
-				self.eval_linear_targets, self.eval_targets_lengths, self.eval_split_infos = eval_queue.dequeue()
-
-			self.eval_inputs.set_shape(self._placeholders[0].shape)
-			self.eval_input_lengths.set_shape(self._placeholders[1].shape)
-			self.eval_speaker_labels.set_shape(self._placeholders[2].shape)
-			self.eval_language_labels.set_shape(self._placeholders[3].shape)
-			self.eval_mel_targets.set_shape(self._placeholders[4].shape)
-			self.eval_token_targets.set_shape(self._placeholders[5].shape)
-			self.eval_linear_targets.set_shape(self._placeholders[6].shape)
-			self.eval_targets_lengths.set_shape(self._placeholders[7].shape)
-			self.eval_split_infos.set_shape(self._placeholders[8].shape)
+			# Training batches: bucketed example indices are turned into padded batches by a parallel map
+			# (by the feeder worker processes if any), batches are prefetched ahead of the training loop
+			dataset = tf.data.Dataset.from_generator(self._train_batches, (tf.int64, tf.int64), (tf.TensorShape([None]), tf.TensorShape([2])))
+			dataset = dataset.map(self._build_train_batch, num_parallel_calls=max(hparams.tacotron_feeder_workers, 1))
+			dataset = dataset.prefetch(hparams.tacotron_feeder_prefetch)
+			outputs = dataset.make_one_shot_iterator().get_next()
+			#Batches are prefetched: the sampler position of a batch is only recorded once the session takes it from the pipeline
+			consumed = tf.py_func(self._consume_batch, [outputs[-1]], tf.int64, stateful=True, name='consume_batch')
+			with tf.control_dependencies([consumed]):
+				for name, tensor in zip(self._names, outputs[:-1]):
+					setattr(self, name, tf.identity(tensor))
+
+			# Test batches: read on demand (only when evaluating), no prefetching
+			dataset = tf.data.Dataset.from_generator(self._test_arrays, tuple(self._types), tuple(tf.TensorShape(x) for x in self._shapes))
+			outputs = dataset.make_one_shot_iterator().get_next()
+			consumed = tf.py_func(self._consume_eval_batch, [], tf.float64, stateful=True, name='consume_eval_batch')
+			with tf.control_dependencies([consumed]):
+				for name, tensor in zip(self._names, outputs):
+					setattr(self, 'eval_' + name, tf.identity(tensor))
 
 	def start_threads(self, session):
-		self._session = session
-		thread = threading.Thread(name='background', target=self._enqueue_next_train_group)
-		thread.daemon = True #Thread will close when parent quits
-		thread.start()
-
-		thread = threading.Thread(name='background', target=self._enqueue_next_test_group)
-		thread.daemon = True #Thread will close when parent quits
-		thread.start()
-
-	def _get_test_groups(self):
-		meta = self._test_meta[self._test_offset]
-		self._test_offset += 1
-
-		text = meta[5]
-
-		input_data = np.asarray(text_to_sequence(text, self._cleaner_names, lang=self._hparams.symbols_lang), dtype=np.int32)
-		mel_target = np.load(os.path.join(self._mel_dir, meta[1]))
-		#Create parallel sequences containing zeros to represent a non finished sequence
-		token_target = np.asarray([0.] * (len(mel_target) - 1))
-		linear_target = np.load(os.path.join(self._linear_dir, meta[2]))
-
-		speaker_label = int(meta[6])
-		language_label = int(meta[7])
-		return (input_data, speaker_label, language_label, mel_target, token_target, linear_target, len(mel_target))
-
-	def make_test_batches(self):
+		'''Starts collecting the batches of the feeder workers, batches are only built once the input tensors are evaluated in session'''
+		if self._workers is not None:
+			self._workers.start()
+
+	def sampler_state(self, staged=0):
+		'''Returns the sampler state (seed, epoch, cursor, carried examples, batch) right after the last batch the session took
+
+		staged: number of the last batches taken that were not trained on yet (held in staging areas), resuming from
+		the returned state yields them again.
+		'''
+		with self._sampler_lock:
+			if len(self._consumed) <= staged:
+				state = dict(self._sampler)
+			else:
+				group, batch = self._consumed[-1 - staged]
+				state = dict(self._group_states[group], batch=batch + 1)
+		state['train_indices'] = self._train_indices_hash()
+		return state
+
+	def save_sampler_state(self, path, staged=0):
+		'''Saves the sampler state next to a checkpoint (written to a temporary file first, a torn state is never read back)'''
+		with open(path + '.tmp', 'w', encoding='utf-8') as f:
+			json.dump(self.sampler_state(staged), f)
+		os.replace(path + '.tmp', path)
+
+	def restore_sampler_state(self, path):
+		'''Resumes training batches where the sampler state of a checkpoint left off, returns False if it can not be used'''
+		if self._sampling:
+			raise RuntimeError('The sampler state must be restored before the first training batch is requested')
+		if not os.path.isfile(path):
+			log('No sampler state at {}, starting a new epoch'.format(path))
+			return False
+		with open(path, encoding='utf-8') as f:
+			state = json.load(f)
+		if state.pop('train_indices', None) != self._train_indices_hash():
+			log('Sampler state {} was saved for other training examples, starting a new epoch'.format(path))
+			return False
+		self._sampler = state
+		log('Resuming training batches at epoch {}, example {}/{} (batch {} of its group)'.format(
+			state['epoch'], state['cursor'], len(self._train_indices), state['batch']))
+		return True
+
+	def _train_indices_hash(self):
+		return hashlib.sha1(np.asarray(self._train_indices, dtype=np.int64).tobytes()).hexdigest()
+
+	def input_wait(self, since, kind='train', staged=0):
+		'''Returns how long a session run started at time since waited for its (train or eval) batch, 0 if it took none
+
+		staged: 1 if the run computed on a batch staged by the previous run while taking the next one, it only waited
+		for the next batch as long as it was taken after its compute was done (run the compute_end() op along).
+		'''
+		if staged:
+			since = max(since, self._compute_end)
+		return max(self._dequeue_times.get(kind, since) - since, 0.)
+
+	def compute_end(self, ops):
+		'''Returns an op recording when ops are done, for input_wait() of runs taking a batch while computing on a staged one'''
+		with tf.device('/cpu:0'), tf.control_dependencies(ops):
+			return tf.py_func(self._mark_compute_end, [], tf.float64, stateful=True, name='compute_end')
+
+	def prefetched_batches(self):
+		'''Returns the number of training batches built and waiting to be taken, and how many the pipeline holds at most'''
+		capacity = self._hparams.tacotron_feeder_prefetch + max(self._hparams.tacotron_feeder_workers, 1)
+		return max(self._built_batches - self._consumed_batches, 0), capacity
+
+	def _consume_batch(self, position):
+		self._dequeue_times['train'] = time.time()
+		with self._sampler_lock:
+			self._consumed_batches += 1
+			self._consumed.append(tuple(int(x) for x in position))
+			#The generator only runs a few groups ahead, states of groups the session is done with are dropped
+			for done in [x for x in self._group_states if x < self._consumed[0][0]]:
+				del self._group_states[done]
+		return position
+
+	def _build_train_batch(self, indices, position):
+		outputs = tf.py_func(self._build_batch, [indices], self._types, stateful=True, name='build_batch')
+		for output, shape in zip(outputs, self._shapes):
+			output.set_shape(shape)
+		return tuple(outputs) + (position, )
+
+	def _build_batch(self, indices):
+		r = self._hparams.outputs_per_step
 		start = time.time()
+		if self._workers is not None:
+			outputs = self._workers.build(indices, r)
+		else:
+			outputs = list(self._builder.build(indices, r))
+		with self._build_time_lock:
+			self._build_time += time.time() - start
+			self._built_batches += 1
+		return outputs
+
+	def _mark_compute_end(self):
+		self._compute_end = time.time()
+		return np.float64(self._compute_end)
+
+	def _consume_eval_batch(self):
+		self._dequeue_times['eval'] = time.time()
+		return np.float64(self._dequeue_times['eval'])
+
+	def pipeline_stats(self):
+		'''Returns the counters of the training input pipeline so far
+
+		The BatchBuilder.stats() counters of the batches built so far (by the feeder workers if any), the seconds
+		spent bucketing examples into batches (sort_time) and handing the batches to the pipeline (enqueue_time: the time
+		building batches took beyond tokenizing, loading and padding them, e.g. going through worker processes).
+		'''
+		stats = self._workers.stats() if self._workers is not None else None
+		if stats is None:
+			stats = self._builder.stats()
+		stats['sort_time'] = self._sort_time
+		stats['enqueue_time'] = self._build_time - stats['tokenize_time'] - stats['load_time'] - stats['pad_time']
+		return stats
 
-		# Read a group of examples
+	def make_test_batches(self):
+		'''Returns the example indices of the test batches (the same ones on every run), and outputs_per_step'''
 		n = self._hparams.tacotron_batch_size
 		r = self._hparams.outputs_per_step
 
-		#Test on entire test set
-		examples = [self._get_test_groups() for i in range(len(self._test_meta))]
-
-		# Bucket examples based on similar output sequence length for efficiency
-		examples.sort(key=lambda x: x[-1])
+		#Test on entire test set, bucket examples based on similar output sequence length for efficiency
+		examples = self._test_indices[np.argsort(self._metadata.mel_frames[self._test_indices], kind='mergesort')]
 		batches = [examples[i: i+n] for i in range(0, len(examples), n)]
-		np.random.shuffle(batches)
-
-		log('\nGenerated {} test batches of size {} in {:.3f} sec'.format(len(batches), n, time.time() - start))
+		np.random.RandomState(self._hparams.tacotron_data_random_state).shuffle(batches)
 		return batches, r
 
-	def _enqueue_next_train_group(self):
-		while not self._coord.should_stop():
+	def _test_arrays(self):
+		#Test batches are padded once into a memory mapped cache and read back when evaluating
+		if self._test_batches is None:
 			start = time.time()
-
-			# Read a group of examples
-			n = self._hparams.tacotron_batch_size
-			r = self._hparams.outputs_per_step
-			examples = [self._get_next_example() for i in range(n * _batches_per_group)]
+			batches, r = self.make_test_batches()
+			self._test_batches = eval_cache(self._eval_cache_dir, self._eval_cache_tag(batches), self._builder, batches, r, self._hparams)
+			log('\nLoaded {} test batches of size {} in {:.3f} sec'.format(len(self._test_batches), self._hparams.tacotron_batch_size, time.time() - start))
+		while True:
+			for i in range(len(self._test_batches)):
+				yield self._test_batches.batch(i)
+
+	def _eval_cache_tag(self, batches):
+		'''Identifies the content of padded test batches: metadata, test examples and the hparams changing their arrays
+
+		train.txt does not change when preprocessing is run again with other audio hparams (or the symbol table with the
+		same cleaners), the audio hparams key, the symbol table and the shards the targets are read from are part of the tag.
+		'''
+		hp = self._hparams
+		tag = {name: getattr(hp, name) for name in ['cleaners', 'symbols_lang', 'outputs_per_step', 'tacotron_num_gpus',
+			'predict_linear', 'symmetric_mels', 'max_abs_value', 'num_mels', 'num_freq']}
+		tag['metadata'] = self._metadata.metadata_hash
+		tag['audio'] = manifest.hparams_key(hp)
+		tag['symbols'] = encoded_text.encoding_tag(self._metadata_filename, hp)['symbols']
+		tag['shards'] = self._metadata.shard_names
+		tag['batches'] = hashlib.sha1(b''.join([np.asarray(batch, dtype=np.int64).tobytes() + b'|' for batch in batches])).hexdigest()
+		return tag
+
+	def _train_batches(self):
+		"""Yields the example indices and sampler position (group, batch) of training batches, endlessly
+
+		Every epoch visits the training examples in the order of a permutation seeded by (seed, epoch). Groups of
+		_batches_per_group batches are bucketed: the examples of a group are sorted by output length (read from the
+		metadata, without loading them) before being cut into batches, either of tacotron_batch_size examples or
+		filling the tacotron_batch_frames (and tacotron_batch_tokens) padded budget, and the batches are shuffled with
+		a seed of (seed, epoch, cursor). A group is thus entirely defined by the sampler state at its start, which is
+		what sampler_state() saves along with the number of its batches already trained on.
+		"""
+		n = self._hparams.tacotron_batch_size
+		self._sampling = True
+		state = self._sampler
+		skip = state['batch']
+		group_id = 0
+		while True:
+			start = time.time()
+			with self._sampler_lock:
+				self._group_states[group_id] = state
+			seed, epoch, cursor = state['seed'], state['epoch'], state['cursor']
+			group, next_epoch, next_cursor = self._take(seed, epoch, cursor, n * _batches_per_group)
+			group = np.concatenate([np.asarray(state['carry'], dtype=np.int64), group])
 
 			# Bucket examples based on similar output sequence length for efficiency
-			examples.sort(key=lambda x: x[-1])
-			batches = [examples[i: i+n] for i in range(0, len(examples), n)]
-			np.random.shuffle(batches)
-
-			log('\nGenerated {} train batches of size {} in {:.3f} sec'.format(len(batches), n, time.time() - start))
-			for batch in batches:
-				feed_dict = dict(zip(self._placeholders, self._prepare_batch(batch, r)))
-				self._session.run(self._enqueue_op, feed_dict=feed_dict)
-
-	def _enqueue_next_test_group(self):
-		#Create test batches once and evaluate on them for all test steps
-		test_batches, r = self.make_test_batches()
-		while not self._coord.should_stop():
-			for batch in test_batches:
-				feed_dict = dict(zip(self._placeholders, self._prepare_batch(batch, r)))
-				self._session.run(self._eval_enqueue_op, feed_dict=feed_dict)
-
-	def _get_next_example(self):
-		"""Gets a single example (input, mel_target, token_target, linear_target, mel_length) from_ disk
-		"""
-		if self._train_offset >= len(self._train_meta):
-			self._train_offset = 0
-			np.random.shuffle(self._train_meta)
-
-		meta = self._train_meta[self._train_offset]
-		self._train_offset += 1
-
-		text = meta[5]
-
-		input_data = np.asarray(text_to_sequence(text, self._cleaner_names, lang=self._hparams.symbols_lang), dtype=np.int32)
-		mel_target = np.load(os.path.join(self._mel_dir, meta[1]))
-		#Create parallel sequences containing zeros to represent a non finished sequence
-		token_target = np.asarray([0.] * (len(mel_target) - 1))
-		linear_target = np.load(os.path.join(self._linear_dir, meta[2]))
-
-		speaker_label = int(meta[6])
-		language_label = int(meta[7])
-		return (input_data, speaker_label, language_label, mel_target, token_target, linear_target, len(mel_target))
-
-	def _prepare_batch(self, batches, outputs_per_step):
-		assert 0 == len(batches) % self._hparams.tacotron_num_gpus
-		size_per_device = int(len(batches) / self._hparams.tacotron_num_gpus)
-		np.random.shuffle(batches)
-
-		inputs = None
-		speaker_labels = None
-		language_labels = None
-		mel_targets = None
-		token_targets = None
-		linear_targets = None
-		targets_lengths = None
-		split_infos = []
-
-		targets_lengths = np.asarray([x[-1] for x in batches], dtype=np.int32) #Used to mask loss
-		input_lengths = np.asarray([len(x[0]) for x in batches], dtype=np.int32)
-		speaker_labels = np.asarray([x[1] for x in batches], dtype=np.int32)
-		language_labels = np.asarray([x[2] for x in batches], dtype=np.int32)
-
-		for i in range(self._hparams.tacotron_num_gpus):
-			batch = batches[size_per_device*i:size_per_device*(i+1)]
-			input_cur_device, input_max_len = self._prepare_inputs([x[0] for x in batch])
-			inputs = np.concatenate((inputs, input_cur_device), axis=1) if inputs is not None else input_cur_device
-			mel_target_cur_device, mel_target_max_len = self._prepare_targets([x[3] for x in batch], outputs_per_step)
-			mel_targets = np.concatenate(( mel_targets, mel_target_cur_device), axis=1) if mel_targets is not None else mel_target_cur_device
-
-			#Pad sequences with 1 to infer that the sequence is done
-			token_target_cur_device, token_target_max_len = self._prepare_token_targets([x[4] for x in batch], outputs_per_step)
-			token_targets = np.concatenate((token_targets, token_target_cur_device), axis=1) if token_targets is not None else token_target_cur_device
-			linear_targets_cur_device, linear_target_max_len = self._prepare_targets([x[5] for x in batch], outputs_per_step)
-			linear_targets = np.concatenate((linear_targets, linear_targets_cur_device), axis=1) if linear_targets is not None else linear_targets_cur_device
-			split_infos.append([input_max_len, mel_target_max_len, token_target_max_len, linear_target_max_len])
-
-		split_infos = np.asarray(split_infos, dtype=np.int32)
-		return (inputs, input_lengths, speaker_labels, language_labels, mel_targets, token_targets, linear_targets, targets_lengths, split_infos)
-
-	def _prepare_inputs(self, inputs):
-		max_len = max([len(x) for x in inputs])
-		return np.stack([self._pad_input(x, max_len) for x in inputs]), max_len
-
-	def _prepare_targets(self, targets, alignment):
-		max_len = max([len(t) for t in targets])
-		data_len = self._round_up(max_len, alignment)
-		return np.stack([self._pad_target(t, data_len) for t in targets]), data_len
-
-	def _prepare_token_targets(self, targets, alignment):
-		max_len = max([len(t) for t in targets]) + 1
-		data_len = self._round_up(max_len, alignment)
-		return np.stack([self._pad_token_target(t, data_len) for t in targets]), data_len
-
-	def _pad_input(self, x, length):
-		return np.pad(x, (0, length - x.shape[0]), mode='constant', constant_values=self._pad)
-
-	def _pad_target(self, t, length):
-		return np.pad(t, [(0, length - t.shape[0]), (0, 0)], mode='constant', constant_values=self._target_pad)
-
-	def _pad_token_target(self, t, length):
-		return np.pad(t, (0, length - t.shape[0]), mode='constant', constant_values=self._token_pad)
+			group = group[np.argsort(self._metadata.mel_frames[group], kind='mergesort')]
+			if self._hparams.tacotron_batch_frames is None:
+				batches = [group[i: i+n] for i in range(0, len(group), n)]
+				carry = group[:0]
+			else:
+				batches, carry = self._fill_batches(group)
+			np.random.RandomState([seed, epoch, cursor]).shuffle(batches)
+			self._sort_time += time.time() - start
+
+			real, padded = self._padding(batches)
+			message = '\nGenerated {} train batches of {:.1f} examples on average in {:.3f} sec, {:.0f} mel frames per batch ({:.1%} padding efficiency'.format(
+				len(batches), np.mean([len(batch) for batch in batches]), time.time() - start, real / len(batches), real / padded)
+			if self._hparams.tacotron_batch_frames is not None:
+				fixed_real, fixed_padded = self._padding([group[i: i+n] for i in range(0, len(group) - n + 1, n)])
+				message += ', {:.0f} frames per batch and {:.1%} efficiency with batches of {}'.format(fixed_real / max(len(group) // n, 1), fixed_real / max(fixed_padded, 1), n)
+			if self._builder.cache is not None:
+				stats = self.pipeline_stats()
+				message += ', example cache: {:.1%} hit rate, {:.0f} MB held'.format(
+					stats['cache_hits'] / max(stats['cache_hits'] + stats['cache_misses'], 1), stats['cache_bytes'] / 1024 / 1024)
+			log(message + ')')
+
+			#A restored group skips the batches trained on before the checkpoint
+			for i in range(skip, len(batches)):
+				yield batches[i], np.array([group_id, i], dtype=np.int64)
+			skip = 0
+			state = {'seed': seed, 'epoch': next_epoch, 'cursor': next_cursor, 'carry': carry.tolist(), 'batch': 0}
+			group_id += 1
+
+	def _take(self, seed, epoch, cursor, count):
+		'''Returns the next count training examples from (epoch, cursor), and the (epoch, cursor) following them'''
+		parts = []
+		while count > 0:
+			order = self._train_order(seed, epoch)
+			part = order[cursor: cursor+count]
+			parts.append(part)
+			count -= len(part)
+			cursor += len(part)
+			if cursor >= len(order):
+				epoch, cursor = epoch + 1, 0
+		return np.concatenate(parts), epoch, cursor
+
+	def _train_order(self, seed, epoch):
+		if self._epoch_order is None or self._epoch_order[0] != (seed, epoch):
+			permutation = np.random.RandomState([seed, epoch]).permutation(len(self._train_indices))
+			self._epoch_order = ((seed, epoch), self._train_indices[permutation])
+		return self._epoch_order[1]
+
+	def _fill_batches(self, group):
+		'''Cuts length sorted examples into the largest batches that fit the padded frame and token budgets'''
+		num_gpus = self._hparams.tacotron_num_gpus
+		r = self._hparams.outputs_per_step
+		frame_budget = self._hparams.tacotron_batch_frames
+		token_budget = self._hparams.tacotron_batch_tokens or np.inf
+		mel_frames = self._round_up(self._metadata.mel_frames[group], r)
+		tokens = self._text_lengths[group]
+
+		batches = []
+		start = 0
+		while len(group) - start >= num_gpus:
+			size = num_gpus
+			max_tokens = tokens[start: start+size].max()
+			while start + size + num_gpus <= len(group):
+				#Examples are sorted by length: the last one of the batch is the longest
+				frames = mel_frames[start + size + num_gpus - 1]
+				max_tokens = max(max_tokens, tokens[start+size: start+size+num_gpus].max())
+				if (size + num_gpus) * frames > frame_budget or (size + num_gpus) * max_tokens > token_budget:
+					break
+				size += num_gpus
+			batches.append(group[start: start+size])
+			start += size
+		#Less examples than GPUs are left, they go to the next group
+		return batches, group[start:]
+
+	def _padding(self, batches):
+		'''Returns the (real, padded) number of mel frames of batches'''
+		r = self._hparams.outputs_per_step
+		real = sum([self._metadata.mel_frames[batch].sum() for batch in batches])
+		padded = sum([len(batch) * self._round_up(self._metadata.mel_frames[batch].max(), r) for batch in batches])
+		return float(real), float(padded)
 
 	def _round_up(self, x, multiple):
-		remainder = x % multiple
-		return x if remainder == 0 else x + multiple - remainder
+		return (x + multiple - 1) // multiple * multiple
 
 	def _round_down(self, x, multiple):
 		remainder = x % multiple
@@ -489,6 +489,19 @@ def sequence_mask(lengths, r, expand=True):
 		return tf.expand_dims(tf.sequence_mask(lengths, maxlen=max_len, dtype=tf.float32), axis=-1)
 	return tf.sequence_mask(lengths, maxlen=max_len, dtype=tf.float32)
 
+def split_towers(x, lengths, num_towers):
+	'''Splits x [batch_size, sum(lengths), ...] along its time axis into num_towers tensors of the given lengths (in graph, no python)
+	'''
+	return tf.split(x, lengths, axis=1, num=num_towers)
+
+def stop_token_targets(lengths, max_len):
+	'''Returns the [batch_size, max_len] <stop_token> targets of sequences of the given lengths
+
+	Frames of a sequence are marked with 0s (not finished) up to its last frame, its last frame and
+	the paddings that follow (up to max_len, a multiple of r) with 1s (finished).
+	'''
+	return 1. - tf.sequence_mask(lengths - 1, maxlen=max_len, dtype=tf.float32)
+
 def MaskedMSE(targets, outputs, targets_lengths, hparams, mask=None):
 	'''Computes a masked Mean Squared Error
 	'''
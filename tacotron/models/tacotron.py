@@ -10,22 +10,13 @@ from tacotron.models.attention import LocationSensitiveAttention
 
 import numpy as np
 
-def split_func(x, split_pos):
-	rst = []
-	start = 0
-	# x will be a numpy array with the contents of the placeholder below
-	for i in range(split_pos.shape[0]):
-		rst.append(x[:,start:start+split_pos[i]])
-		start += split_pos[i]
-	return rst
-
 class Tacotron():
 	"""Tacotron-2 Feature prediction Model.
 	"""
 	def __init__(self, hparams):
 		self._hparams = hparams
 
-	def initialize(self, inputs, speaker_labels, language_labels, input_lengths, mel_targets=None, stop_token_targets=None, linear_targets=None, targets_lengths=None, gta=False,
+	def initialize(self, inputs, speaker_labels, language_labels, input_lengths, mel_targets=None, linear_targets=None, targets_lengths=None, gta=False,
 			global_step=None, is_training=False, is_evaluating=False, split_infos=None):
 		"""
 		Initializes the model for inference
@@ -42,11 +33,11 @@ class Tacotron():
 			- mel_targets: float32 Tensor with shape [N, T_out, M] where N is batch size, T_out is number
 			  of steps in the output time series, M is num_mels, and values are entries in the mel
 			  spectrogram. Only needed for training.
+			- targets_lengths: int32 Tensor with shape [N] where N is batch size and values are the lengths
+			  of each sequence in mel_targets. <stop_token> targets and loss masks are derived from it.
 		"""
-		if mel_targets is None and stop_token_targets is not None:
-			raise ValueError('no multi targets were provided but token_targets were given')
-		if mel_targets is not None and stop_token_targets is None and not gta:
-			raise ValueError('Mel targets are provided without corresponding token_targets')
+		if mel_targets is not None and targets_lengths is None and not gta:
+			raise ValueError('Mel targets are provided without corresponding targets_lengths')
 		if not gta and self._hparams.predict_linear==True and linear_targets is None and is_training:
 			raise ValueError('Model is set to use post processing to predict linear spectrograms in training but no linear targets given!')
 		if gta and linear_targets is not None:
@@ -59,18 +50,16 @@ class Tacotron():
 		split_device = '/cpu:0' if self._hparams.tacotron_num_gpus > 1 or self._hparams.split_on_cpu else '/gpu:{}'.format(self._hparams.tacotron_gpu_start_idx)
 		with tf.device(split_device):
 			hp = self._hparams
-			lout_int = [tf.int32]*hp.tacotron_num_gpus
-			lout_float = [tf.float32]*hp.tacotron_num_gpus
 
 			tower_input_lengths = tf.split(input_lengths, num_or_size_splits=hp.tacotron_num_gpus, axis=0)
 			tower_targets_lengths = tf.split(targets_lengths, num_or_size_splits=hp.tacotron_num_gpus, axis=0) if targets_lengths is not None else targets_lengths
 			tower_speaker_labels = tf.split(speaker_labels, num_or_size_splits=hp.tacotron_num_gpus, axis=0)
 			tower_language_labels = tf.split(language_labels, num_or_size_splits=hp.tacotron_num_gpus, axis=0)
 
-			p_inputs = tf.py_func(split_func, [inputs, split_infos[:, 0]], lout_int)
-			p_mel_targets = tf.py_func(split_func, [mel_targets, split_infos[:,1]], lout_float) if mel_targets is not None else mel_targets
-			p_stop_token_targets = tf.py_func(split_func, [stop_token_targets, split_infos[:,2]], lout_float) if stop_token_targets is not None else stop_token_targets
-			p_linear_targets = tf.py_func(split_func, [linear_targets, split_infos[:,3]], lout_float) if linear_targets is not None else linear_targets
+			#Batches hold one block per GPU along the time axis, each padded to its own length given by split_infos
+			p_inputs = split_towers(inputs, split_infos[:, 0], hp.tacotron_num_gpus)
+			p_mel_targets = split_towers(mel_targets, split_infos[:, 1], hp.tacotron_num_gpus) if mel_targets is not None else mel_targets
+			p_linear_targets = split_towers(linear_targets, split_infos[:, 2], hp.tacotron_num_gpus) if linear_targets is not None else linear_targets
 
 			tower_inputs = []
 			tower_mel_targets = []
@@ -84,8 +73,6 @@ class Tacotron():
 				tower_inputs.append(tf.reshape(p_inputs[i], [batch_size, -1]))
 				if p_mel_targets is not None:
 					tower_mel_targets.append(tf.reshape(p_mel_targets[i], [batch_size, -1, mel_channels]))
-				if p_stop_token_targets is not None:
-					tower_stop_token_targets.append(tf.reshape(p_stop_token_targets[i], [batch_size, -1]))
 				if p_linear_targets is not None:
 					tower_linear_targets.append(tf.reshape(p_linear_targets[i], [batch_size, -1, linear_channels]))
 
@@ -107,8 +94,25 @@ class Tacotron():
 		
 		# 1. Declare GPU Devices
 		gpus = ["/gpu:{}".format(i) for i in range(hp.tacotron_gpu_start_idx, hp.tacotron_gpu_start_idx+hp.tacotron_num_gpus)]
+
+		#Training batches are copied to the GPUs one step ahead by running self.stage along with every training step.
+		#Decided from hparams only: probing the devices here would open a session grabbing all GPU memory before
+		#the training session applies allow_growth
+		if is_training and hp.tacotron_stage_batches:
+			tower_inputs, tower_input_lengths, tower_speaker_labels, tower_language_labels, tower_mel_targets, tower_targets_lengths, tower_linear_targets = self._stage_towers(
+				gpus, [tower_inputs, tower_input_lengths, tower_speaker_labels, tower_language_labels, tower_mel_targets, tower_targets_lengths, tower_linear_targets])
+		else:
+			#Nothing to stage (staging disabled, eval or synthesis): the towers read the input batch directly
+			self.stage = tf.no_op(name='stage')
+			self.staged_batches = 0
+
 		for i in range(hp.tacotron_num_gpus):
 			with tf.device(tf.train.replica_device_setter(ps_tasks=1,ps_device="/cpu:0",worker_device=gpus[i])):
+				if tower_mel_targets and tower_targets_lengths is not None:
+					tower_stop_token_targets.append(stop_token_targets(tower_targets_lengths[i], tf.shape(tower_mel_targets[i])[1]))
+				#Size of the tower batch (the staged one when staging)
+				batch_size = tf.shape(tower_inputs[i])[0]
+
 				with tf.variable_scope('inference') as scope:
 					assert hp.tacotron_teacher_forcing_mode in ('constant', 'scheduled')
 					if hp.tacotron_teacher_forcing_mode == 'scheduled' and is_training:
@@ -321,6 +325,29 @@ class Tacotron():
 			log('  Tacotron Parameters       {:.3f} Million.'.format(np.sum([np.prod(v.get_shape().as_list()) for v in self.all_vars]) / 1000000))
 
 
+	def _stage_towers(self, gpus, towers):
+		"""Stages the batch of every tower on its GPU, returns the tower lists with the staged tensors
+
+		Each GPU gets a StagingArea: running self.stage puts the batch taken from the input pipeline into it (copying it
+		to the GPU) while the step computes on the batch taken out of it, put there by the previous run of self.stage.
+		The training loop runs self.stage once before the first step. Missing (None or empty) tower lists are kept.
+		"""
+		present = [j for j, tensors in enumerate(towers) if tensors]
+		staged = [[] if j in present else tensors for j, tensors in enumerate(towers)]
+		puts = []
+		for i, gpu in enumerate(gpus):
+			tensors = [towers[j][i] for j in present]
+			with tf.device(gpu):
+				area = tf.contrib.staging.StagingArea([x.dtype for x in tensors], shapes=[x.shape for x in tensors], name='stage_{}'.format(i))
+				puts.append(area.put(tensors))
+				outputs = area.get()
+			for j, output in zip(present, outputs):
+				staged[j].append(output)
+
+		self.stage = tf.group(*puts, name='stage')
+		self.staged_batches = 1
+		return staged
+
 	def add_loss(self):
 		'''Adds loss to the model. Sets "loss" field. initialize must have been called.'''
 		hp = self._hparams
@@ -362,7 +389,7 @@ class Tacotron():
 						if hp.predict_linear:
 							#Compute Linear L1 mask loss (priority to low frequencies)
 							linear_loss = MaskedLinearLoss(self.tower_linear_targets[i], self.tower_linear_outputs[i],
-								self.targets_lengths, hparams=self._hparams)
+								self.tower_targets_lengths[i], hparams=self._hparams)
 						else:
 							linear_loss=0.
 					else:
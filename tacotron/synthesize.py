@@ -4,7 +4,9 @@ import re
 import time
 from time import sleep
 
+import numpy as np
 import tensorflow as tf
+from datasets import metadata, store
 from hparams import hparams, hparams_debug_string
 from infolog import log
 from tacotron.synthesizer import Synthesizer
@@ -90,33 +92,46 @@ def run_synthesis(args, checkpoint_path, output_dir, hparams):
 	log(hparams_debug_string())
 	synth = Synthesizer()
 	synth.load(checkpoint_path, hparams, gta=GTA)
-	with open(metadata_filename, encoding='utf-8') as f:
-		metadata = [line.strip().split('|') for line in f]
-		frame_shift_ms = hparams.hop_size / hparams.sample_rate
-		hours = sum([int(x[4]) for x in metadata]) * frame_shift_ms / (3600)
-		log('Loaded metadata for {} examples ({:.2f} hours)'.format(len(metadata), hours))
+	#Synthesis only reads mel targets (in GTA mode), never the linear spectrograms
+	index = metadata.load_or_build(metadata_filename, log, linear=False)
+	frame_shift_ms = hparams.hop_size / hparams.sample_rate
+	hours = index.total_mel_frames * frame_shift_ms / (3600)
+	log('Loaded metadata for {} examples ({:.2f} hours)'.format(len(index), hours))
 
 	#Set inputs batch wise
-	metadata = [metadata[i: i+hparams.tacotron_synthesis_batch_size] for i in range(0, len(metadata), hparams.tacotron_synthesis_batch_size)]
+	batches = [range(i, min(i + hparams.tacotron_synthesis_batch_size, len(index))) for i in range(0, len(index), hparams.tacotron_synthesis_batch_size)]
 
 	log('Starting Synthesis')
 	mel_dir = os.path.join(args.input_dir, 'mels')
 	wav_dir = os.path.join(args.input_dir, 'audio')
+	#map.txt points to .npy files: targets and audio stored in shards are exported next to the synthesized mels
+	mel_store = store.open_store(mel_dir)
+	wav_store = store.open_store(wav_dir)
 	with open(os.path.join(synth_dir, 'map.txt'), 'w') as file:
-		for i, meta in enumerate(tqdm(metadata)):
-			texts = [m[5] for m in meta]
-			speakers = [m[6] for m in meta]
-			languages = [m[7] for m in meta]
-			mel_filenames = [os.path.join(mel_dir, m[1]) for m in meta]
-			wav_filenames = [os.path.join(wav_dir, m[0]) for m in meta]
+		for rows in tqdm(batches):
+			texts = [index.text(j) for j in rows]
+			speakers = index.speakers[rows.start:rows.stop].tolist()
+			languages = index.languages[rows.start:rows.stop].tolist()
+			mel_filenames = [os.path.join(mel_dir, index.mel_name(j)) for j in rows]
 			basenames = [os.path.basename(m).replace('.npy', '').replace('mel-', '') for m in mel_filenames]
 			mel_output_filenames, speaker_ids = synth.synthesize(texts, speakers, languages, basenames, synth_dir, None, mel_filenames)
 
+			wav_filenames = [_npy_path(wav_store, wav_dir, index.audio_name(j), os.path.join(synth_dir, 'audio')) for j in rows]
+			mel_filenames = [_npy_path(mel_store, mel_dir, index.mel_name(j), os.path.join(synth_dir, 'targets')) for j in rows]
 			for elems in zip(wav_filenames, mel_filenames, mel_output_filenames, speaker_ids, texts):
 				file.write('|'.join([str(x) for x in elems]) + '\n')
 	log('synthesized mel spectrograms at {}'.format(synth_dir))
 	return os.path.join(synth_dir, 'map.txt')
 
+def _npy_path(reader, directory, name, export_dir):
+	'''Path of the .npy file of a training data array, exported into export_dir first if it is stored in shards'''
+	if not isinstance(reader, store.ShardReader):
+		return os.path.join(directory, name)
+	os.makedirs(export_dir, exist_ok=True)
+	path = os.path.join(export_dir, name)
+	np.save(path, reader.load(name), allow_pickle=False)
+	return path
+
 def tacotron_synthesize(args, hparams, checkpoint, sentences=None, speakers=None, languages=None):
 	output_dir = 'tacotron_' + args.output_dir
 
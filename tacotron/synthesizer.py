@@ -4,7 +4,7 @@ from datetime import datetime
 
 import numpy as np
 import tensorflow as tf
-from datasets import audio
+from datasets import audio, store
 from infolog import log
 from librosa import effects
 from tacotron.models import create_model
@@ -37,6 +37,7 @@ class Synthesizer:
 
 		self.gta = gta
 		self._hparams = hparams
+		self._stores = {}
 		#pad input sequences with the <pad_token> 0 ( _ )
 		self._pad = 0
 		#explicitely setting the padding to a value that doesn't originally exist in the spectogram
@@ -92,7 +93,7 @@ class Synthesizer:
 			device_input = seqs[size_per_device*i: size_per_device*(i+1)]
 			device_input, max_seq_len = self._prepare_inputs(device_input)
 			input_seqs = np.concatenate((input_seqs, device_input), axis=1) if input_seqs is not None else device_input
-			split_infos.append([max_seq_len, 0, 0, 0])
+			split_infos.append([max_seq_len, 0, 0])
 
 		feed_dict = {
 			self.inputs: input_seqs,
@@ -102,7 +103,7 @@ class Synthesizer:
 		}
 
 		if self.gta:
-			np_targets = [np.load(mel_filename) for mel_filename in mel_filenames]
+			np_targets = [self._load_target(mel_filename) for mel_filename in mel_filenames]
 			target_lengths = [len(np_target) for np_target in np_targets]
 
 			#pad targets according to each GPU max length
@@ -177,6 +178,12 @@ class Synthesizer:
 			return
 
 
+		if log_dir is not None:
+			#Invert the whole batch at once rather than one utterance at a time
+			wavs = audio.inv_mel_spectrograms([mel.T for mel in mels], hparams)
+			if hparams.predict_linear:
+				linear_wavs = audio.inv_linear_spectrograms([linear.T for linear in linears], hparams)
+
 		saved_mels_paths = []
 		speaker_ids = []
 		for i, mel in enumerate(mels):
@@ -197,8 +204,7 @@ class Synthesizer:
 
 			if log_dir is not None:
 				#save wav (mel -> wav)
-				wav = audio.inv_mel_spectrogram(mel.T, hparams)
-				audio.save_wav(wav, os.path.join(log_dir, 'wavs/wav-{}-mel.wav'.format(basenames[i])), sr=hparams.sample_rate)
+				audio.save_wav(wavs[i], os.path.join(log_dir, 'wavs/wav-{}-mel.wav'.format(basenames[i])), sr=hparams.sample_rate)
 
 				#save alignments
 				plot.plot_alignment(alignments[i], os.path.join(log_dir, 'plots/alignment-{}.png'.format(basenames[i])),
@@ -210,8 +216,7 @@ class Synthesizer:
 
 				if hparams.predict_linear:
 					#save wav (linear -> wav)
-					wav = audio.inv_linear_spectrogram(linears[i].T, hparams)
-					audio.save_wav(wav, os.path.join(log_dir, 'wavs/wav-{}-linear.wav'.format(basenames[i])), sr=hparams.sample_rate)
+					audio.save_wav(linear_wavs[i], os.path.join(log_dir, 'wavs/wav-{}-linear.wav'.format(basenames[i])), sr=hparams.sample_rate)
 
 					#save linear spectrogram plot
 					plot.plot_spectrogram(linears[i], os.path.join(log_dir, 'plots/linear-{}.png'.format(basenames[i])),
@@ -221,6 +226,13 @@ class Synthesizer:
 
 		return saved_mels_paths, speaker_ids
 
+	def _load_target(self, mel_filename):
+		#Mel targets may be stored as .npy files or inside shards of the training data directory
+		mel_dir, name = os.path.split(mel_filename)
+		if mel_dir not in self._stores:
+			self._stores[mel_dir] = store.open_store(mel_dir)
+		return self._stores[mel_dir].load(name)
+
 	def _round_up(self, x, multiple):
 		remainder = x % multiple
 		return x if remainder == 0 else x + multiple - remainder
@@ -1,4 +1,5 @@
 import argparse
+import glob
 import os
 import subprocess
 import time
@@ -62,12 +63,24 @@ def add_train_stats(model, hparams):
 		tf.summary.scalar('max_gradient_norm', tf.reduce_max(gradient_norms)) #visualize gradients (in case of explosion)
 		return tf.summary.merge_all()
 
-def add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, stop_token_loss, loss):
+def add_input_stats(summary_writer, step, step_time, input_wait, prefetched, capacity):
+	#Averages over the last steps: a training step waiting for its batch means the feeder is too slow
+	values = [
+	tf.Summary.Value(tag='Tacotron_model/input_stats/step_time', simple_value=step_time),
+	tf.Summary.Value(tag='Tacotron_model/input_stats/input_wait', simple_value=input_wait),
+	tf.Summary.Value(tag='Tacotron_model/input_stats/compute_time', simple_value=max(step_time - input_wait, 0.)),
+	tf.Summary.Value(tag='Tacotron_model/input_stats/prefetched_batches', simple_value=prefetched),
+	tf.Summary.Value(tag='Tacotron_model/input_stats/prefetch_fill', simple_value=prefetched / capacity),
+	]
+	summary_writer.add_summary(tf.Summary(value=values), step)
+
+def add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, stop_token_loss, loss, input_wait):
 	values = [
 	tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/eval_before_loss', simple_value=before_loss),
 	tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/eval_after_loss', simple_value=after_loss),
 	tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/stop_token_loss', simple_value=stop_token_loss),
 	tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/eval_loss', simple_value=loss),
+	tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/eval_input_wait', simple_value=input_wait),
 	]
 	if linear_loss is not None:
 		values.append(tf.Summary.Value(tag='Tacotron_eval_model/eval_stats/eval_linear_loss', simple_value=linear_loss))
@@ -77,6 +90,21 @@ def add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, s
 def time_string():
 	return datetime.now().strftime('%Y-%m-%d %H:%M')
 
+def sampler_state_path(checkpoint_path):
+	return '{}.sampler.json'.format(checkpoint_path)
+
+def save_checkpoint(sess, saver, feeder, checkpoint_path, global_step, staged_batches=0):
+	'''Saves the model and, next to it, the feeder sampler state to resume training batches from'''
+	path = saver.save(sess, checkpoint_path, global_step=global_step)
+	#Batches staged on the GPUs were not trained on yet: a restored run feeds them again
+	feeder.save_sampler_state(sampler_state_path(path), staged_batches)
+
+	#Drop the sampler states of the checkpoints the saver deleted
+	kept = set([sampler_state_path(x) for x in saver.last_checkpoints])
+	for state_path in glob.glob(sampler_state_path(checkpoint_path + '-*')):
+		if state_path not in kept:
+			os.remove(state_path)
+
 def model_train_mode(args, feeder, hparams, global_step):
 	with tf.variable_scope('Tacotron_model', reuse=tf.AUTO_REUSE) as scope:
 		model_name = None
@@ -84,11 +112,11 @@ def model_train_mode(args, feeder, hparams, global_step):
 			model_name = 'Tacotron'
 		model = create_model(model_name or args.model, hparams)
 		if hparams.predict_linear:
-			model.initialize(feeder.inputs, feeder.speaker_labels, feeder.language_labels, feeder.input_lengths, feeder.mel_targets, feeder.token_targets, linear_targets=feeder.linear_targets,
+			model.initialize(feeder.inputs, feeder.speaker_labels, feeder.language_labels, feeder.input_lengths, feeder.mel_targets, linear_targets=feeder.linear_targets,
 				targets_lengths=feeder.targets_lengths, global_step=global_step,
 				is_training=True, split_infos=feeder.split_infos)
 		else:
-			model.initialize(feeder.inputs, feeder.speaker_labels, feeder.language_labels, feeder.input_lengths, feeder.mel_targets, feeder.token_targets,
+			model.initialize(feeder.inputs, feeder.speaker_labels, feeder.language_labels, feeder.input_lengths, feeder.mel_targets,
 				targets_lengths=feeder.targets_lengths, global_step=global_step,
 				is_training=True, split_infos=feeder.split_infos)
 		model.add_loss()
@@ -103,11 +131,11 @@ def model_test_mode(args, feeder, hparams, global_step):
 			model_name = 'Tacotron'
 		model = create_model(model_name or args.model, hparams)
 		if hparams.predict_linear:
-			model.initialize(feeder.eval_inputs, feeder.eval_speaker_labels, feeder.eval_language_labels, feeder.eval_input_lengths, feeder.eval_mel_targets, feeder.eval_token_targets,
+			model.initialize(feeder.eval_inputs, feeder.eval_speaker_labels, feeder.eval_language_labels, feeder.eval_input_lengths, feeder.eval_mel_targets,
 				linear_targets=feeder.eval_linear_targets, targets_lengths=feeder.eval_targets_lengths, global_step=global_step,
 				is_training=False, is_evaluating=True, split_infos=feeder.eval_split_infos)
 		else:
-			model.initialize(feeder.eval_inputs, feeder.eval_speaker_labels, feeder.eval_language_labels, feeder.eval_input_lengths, feeder.eval_mel_targets, feeder.eval_token_targets,
+			model.initialize(feeder.eval_inputs, feeder.eval_speaker_labels, feeder.eval_language_labels, feeder.eval_input_lengths, feeder.eval_mel_targets,
 				targets_lengths=feeder.eval_targets_lengths, global_step=global_step, is_training=False, is_evaluating=True, 
 				split_infos=feeder.eval_split_infos)
 		model.add_loss()
@@ -156,6 +184,8 @@ def train(log_dir, args, hparams):
 	#Set up model:
 	global_step = tf.Variable(0, name='global_step', trainable=False)
 	model, stats = model_train_mode(args, feeder, hparams, global_step)
+	#With staging, a step takes the next batch while computing: it only waits for it past the end of its compute
+	compute_end = feeder.compute_end([model.optimize])
 	eval_model = model_test_mode(args, feeder, hparams, global_step)
 
 	#Embeddings metadata
@@ -183,6 +213,9 @@ def train(log_dir, args, hparams):
 	step = 0
 	time_window = ValueWindow(100)
 	loss_window = ValueWindow(100)
+	#Time each step waited for its batch, and training batches ready when it started
+	wait_window = ValueWindow(100)
+	prefetch_window = ValueWindow(100)
 	saver = tf.train.Saver(max_to_keep=5)
 
 	log('Tacotron training set to a maximum of {} steps'.format(args.tacotron_train_steps))
@@ -208,28 +241,34 @@ def train(log_dir, args, hparams):
 					if (checkpoint_state and checkpoint_state.model_checkpoint_path):
 						log('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path), slack=True)
 						saver.restore(sess, checkpoint_state.model_checkpoint_path)
+						feeder.restore_sampler_state(sampler_state_path(checkpoint_state.model_checkpoint_path))
 
 					else:
 						log('No model to load at {}'.format(save_dir), slack=True)
-						saver.save(sess, checkpoint_path, global_step=global_step)
+						save_checkpoint(sess, saver, feeder, checkpoint_path, global_step)
 
 				except tf.errors.OutOfRangeError as e:
 					log('Cannot restore checkpoint: {}'.format(e), slack=True)
 			else:
 				log('Starting new training!', slack=True)
-				saver.save(sess, checkpoint_path, global_step=global_step)
+				save_checkpoint(sess, saver, feeder, checkpoint_path, global_step)
 
 			#initializing feeder
 			feeder.start_threads(sess)
+			#Copy the first training batch to the GPUs, the following ones are staged while the previous step runs
+			sess.run(model.stage)
 
 			#Training loop
 			while not coord.should_stop() and step < args.tacotron_train_steps:
+				prefetched, capacity = feeder.prefetched_batches()
 				start_time = time.time()
-				step, loss, opt = sess.run([global_step, model.loss, model.optimize])
+				step, loss, opt, _, _ = sess.run([global_step, model.loss, model.optimize, model.stage, compute_end])
 				time_window.append(time.time() - start_time)
+				wait_window.append(feeder.input_wait(start_time, staged=model.staged_batches))
+				prefetch_window.append(prefetched)
 				loss_window.append(loss)
-				message = 'Step {:7d} [{:.3f} sec/step, loss={:.5f}, avg_loss={:.5f}]'.format(
-					step, time_window.average, loss, loss_window.average)
+				message = 'Step {:7d} [{:.3f} sec/step ({:.3f} waiting for input, {:.1f}/{} batches ready), loss={:.5f}, avg_loss={:.5f}]'.format(
+					step, time_window.average, wait_window.average, prefetch_window.average, capacity, loss, loss_window.average)
 				log(message, end='\r', slack=(step % args.checkpoint_interval == 0))
 
 				if loss > 100 or np.isnan(loss):
@@ -238,7 +277,8 @@ def train(log_dir, args, hparams):
 
 				if step % args.summary_interval == 0:
 					log('\nWriting summary at step {}'.format(step))
-					summary_writer.add_summary(sess.run(stats), step)
+					summary_writer.add_summary(sess.run([stats, model.stage])[0], step)
+					add_input_stats(summary_writer, step, time_window.average, wait_window.average, prefetch_window.average, capacity)
 
 				if step % args.eval_interval == 0:
 					#Run eval and save eval stats
@@ -249,10 +289,12 @@ def train(log_dir, args, hparams):
 					after_losses = []
 					stop_token_losses = []
 					linear_losses = []
+					input_waits = []
 					linear_loss = None
 
 					if hparams.predict_linear:
 						for i in tqdm(range(feeder.test_steps)):
+							eval_start = time.time()
 							eloss, before_loss, after_loss, stop_token_loss, linear_loss, mel_p, mel_t, t_len, align, lin_p, lin_t = sess.run([
 								eval_model.tower_loss[0], eval_model.tower_before_loss[0], eval_model.tower_after_loss[0],
 								eval_model.tower_stop_token_loss[0], eval_model.tower_linear_loss[0], eval_model.tower_mel_outputs[0][0],
@@ -260,6 +302,7 @@ def train(log_dir, args, hparams):
 								eval_model.tower_alignments[0][0], eval_model.tower_linear_outputs[0][0],
 								eval_model.tower_linear_targets[0][0],
 								])
+							input_waits.append(feeder.input_wait(eval_start, 'eval'))
 							eval_losses.append(eloss)
 							before_losses.append(before_loss)
 							after_losses.append(after_loss)
@@ -272,11 +315,13 @@ def train(log_dir, args, hparams):
 
 					else:
 						for i in tqdm(range(feeder.test_steps)):
+							eval_start = time.time()
 							eloss, before_loss, after_loss, stop_token_loss, mel_p, mel_t, t_len, align = sess.run([
 								eval_model.tower_loss[0], eval_model.tower_before_loss[0], eval_model.tower_after_loss[0],
 								eval_model.tower_stop_token_loss[0], eval_model.tower_mel_outputs[0][0], eval_model.tower_mel_targets[0][0],
 								eval_model.tower_targets_lengths[0][0], eval_model.tower_alignments[0][0]
 								])
+							input_waits.append(feeder.input_wait(eval_start, 'eval'))
 							eval_losses.append(eloss)
 							before_losses.append(before_loss)
 							after_losses.append(after_loss)
@@ -286,6 +331,7 @@ def train(log_dir, args, hparams):
 					before_loss = sum(before_losses) / len(before_losses)
 					after_loss = sum(after_losses) / len(after_losses)
 					stop_token_loss = sum(stop_token_losses) / len(stop_token_losses)
+					input_wait = sum(input_waits) / len(input_waits)
 
 					log('Saving eval log to {}..'.format(eval_dir))
 					#Save some log to monitor model improvement on same unseen sequence
@@ -304,14 +350,14 @@ def train(log_dir, args, hparams):
 							title='{}, {}, step={}, loss={:.5f}'.format(args.model, time_string(), step, eval_loss), target_spectrogram=lin_t,
 							max_len=t_len, auto_aspect=True)
 
-					log('Eval loss for global step {}: {:.3f}'.format(step, eval_loss))
+					log('Eval loss for global step {}: {:.3f} ({:.3f} sec per batch waiting for input)'.format(step, eval_loss, input_wait))
 					log('Writing eval summary!')
-					add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, stop_token_loss, eval_loss)
+					add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, stop_token_loss, eval_loss, input_wait)
 
 
 				if step % args.checkpoint_interval == 0 or step == args.tacotron_train_steps or step == 300:
-					#Save model and current global step
-					saver.save(sess, checkpoint_path, global_step=global_step)
+					#Save model, current global step and the sampler state of the feeder
+					save_checkpoint(sess, saver, feeder, checkpoint_path, global_step, model.staged_batches)
 
 					log('\nSaving alignment, Mel-Spectrograms and griffin-lim inverted waveform..')
 					if hparams.predict_linear:
@@ -323,7 +369,8 @@ def train(log_dir, args, hparams):
 							model.tower_mel_targets[0][0],
 							model.tower_targets_lengths[0][0],
 							model.tower_linear_targets[0][0],
-							])
+							model.stage,
+							])[:-1]
 
 						#save predicted linear spectrogram to disk (debug)
 						linear_filename = 'linear-prediction-step-{}.npy'.format(step)
@@ -345,7 +392,8 @@ def train(log_dir, args, hparams):
 							model.tower_alignments[0][0],
 							model.tower_mel_targets[0][0],
 							model.tower_targets_lengths[0][0],
-							])
+							model.stage,
+							])[:-1]
 
 					#save predicted mel spectrogram to disk (debug)
 					mel_filename = 'mel-prediction-step-{}.npy'.format(step)
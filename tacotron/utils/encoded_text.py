@@ -0,0 +1,108 @@
+'''
+Pre-tokenized text of a metadata file (train.txt).
+
+The symbol ids of every row are concatenated in one compact array saved next to the metadata file, with
+the offsets of each row and a tag identifying the cleaners, the symbol table and the metadata they were
+built from. Loading them once lets the data feeder skip the text cleaners entirely during training.
+'''
+import array
+import hashlib
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from datasets.manifest import file_hash
+
+from .symbols import symbols
+from .text import text_to_sequence
+
+_ids_file = 'text_ids.npy'
+_offsets_file = 'text_offsets.npy'
+_tag_file = 'text_ids.json'
+
+
+class EncodedText:
+  '''Symbol id sequences of the metadata rows, row i is a slice of one flat array'''
+  def __init__(self, ids, offsets):
+    self._ids = ids
+    self._offsets = offsets
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def __getitem__(self, i):
+    return self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+  def length(self, i):
+    return int(self._offsets[i + 1] - self._offsets[i])
+
+  def lengths(self):
+    return np.diff(self._offsets)
+
+
+def encoding_tag(metadata_filename, hparams):
+  '''Identifies an encoding: cleaners, symbol table version and content of the metadata file'''
+  lang = hparams.symbols_lang
+  return {
+    'cleaners': ','.join(_cleaner_names(hparams)),
+    'lang': lang,
+    'symbols': hashlib.sha1('\n'.join(symbols(lang)).encode('utf-8')).hexdigest()[:16],
+    'metadata': file_hash(metadata_filename),
+  }
+
+
+def encode_metadata(metadata_filename, hparams, n_jobs=1, save=True):
+  '''Converts the text of every metadata row to symbol ids, optionally saving them next to the metadata file'''
+  lang = hparams.symbols_lang
+  dtype = np.uint8 if len(symbols(lang)) <= 256 else np.uint16
+  encode = partial(_encode, cleaner_names=_cleaner_names(hparams), lang=lang)
+
+  with open(metadata_filename, encoding='utf-8') as f:
+    texts = [line.strip().split('|')[5] for line in f]
+
+  ids = array.array('B' if dtype == np.uint8 else 'H')
+  offsets = array.array('q', [0])
+  if n_jobs > 1:
+    with Pool(n_jobs) as pool:
+      for sequence in pool.imap(encode, texts, chunksize=256):
+        ids.extend(sequence)
+        offsets.append(len(ids))
+  else:
+    for sequence in map(encode, texts):
+      ids.extend(sequence)
+      offsets.append(len(ids))
+
+  ids = np.frombuffer(ids, dtype=dtype)
+  offsets = np.frombuffer(offsets, dtype=np.int64)
+  if save:
+    out_dir = os.path.dirname(metadata_filename)
+    np.save(os.path.join(out_dir, _ids_file), ids, allow_pickle=False)
+    np.save(os.path.join(out_dir, _offsets_file), offsets, allow_pickle=False)
+    #The tag is written last: an interrupted encoding is never picked up
+    with open(os.path.join(out_dir, _tag_file), 'w', encoding='utf-8') as f:
+      json.dump(encoding_tag(metadata_filename, hparams), f)
+  return EncodedText(ids, offsets)
+
+
+def load(metadata_filename, hparams):
+  '''Loads the symbol ids saved next to a metadata file, None if missing or built with other cleaners/symbols/metadata'''
+  out_dir = os.path.dirname(metadata_filename)
+  tag_path = os.path.join(out_dir, _tag_file)
+  if not os.path.isfile(tag_path):
+    return None
+  with open(tag_path, encoding='utf-8') as f:
+    if json.load(f) != encoding_tag(metadata_filename, hparams):
+      return None
+  ids = np.load(os.path.join(out_dir, _ids_file), mmap_mode='r')
+  offsets = np.load(os.path.join(out_dir, _offsets_file))
+  return EncodedText(ids, offsets)
+
+
+def _cleaner_names(hparams):
+  return [x.strip() for x in hparams.cleaners.split(',')]
+
+
+def _encode(text, cleaner_names, lang):
+  return text_to_sequence(text, cleaner_names, lang)